@@ -0,0 +1,302 @@
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import date, datetime, timedelta
+
+from darkstat.metrics import timed
+
+
+# Long-term WAN traffic archive. darkstat only keeps 60 minutes, 24 hours and
+# 31 days; every graphs.xml (or export) a WAN instance is read from is folded
+# into a fixed-size file per instance that keeps much more:
+#
+#   minutes  one bucket per minute   retention["minutes"] buckets
+#   hours    one per hour            retention["hours"]
+#   days     one per day             retention["days"]
+#   months   one per month           retention["months"]
+#
+# Minutes, hours and days come straight from darkstat's own graphs, which it
+# already downsamples and which stay complete while this API is not running;
+# months are summed from the days. Every tier is a ring of (start, in, out)
+# slots indexed by its bucket number, so the file never grows and a range
+# query only touches the buckets it returns.
+#
+# Each poll sees the same bars again (and the current bar growing), so a
+# bucket keeps the largest count seen for it rather than adding samples up.
+# That also keeps the archive intact when darkstat restarts and reports zeros
+# for the bars it lost.
+#
+# The file is mapped shared: with several worker processes the leader writes
+# it (under flock) and the others read the same pages.
+#
+# Layout (header little-endian, arrays native int64), layout_version 1:
+#   4s  magic "DKTA"
+#   H   layout version
+#   H   number of tiers
+#   I   slots per tier (minutes, hours, days, months)
+#   then per tier: start[slots], in[slots], out[slots]
+
+archive_dir = os.environ.get("DARKSTAT_ARCHIVE_DIR", "/home/guru/darkstat_traffic")
+
+retention = {
+    "minutes": 7 * 24 * 60,  # a week
+    "hours": 90 * 24,        # a quarter
+    "days": 3 * 366,         # three years, must exceed darkstat's 31 days
+    "months": 20 * 12,
+}
+
+max_range_points = 10000  # output buckets a single range query may ask for
+
+TIERS = ("minutes", "hours", "days", "months")
+# Nominal bucket length, used to pick a tier for a step and to check retention
+RESOLUTION = {"minutes": 60, "hours": 3600, "days": 86400, "months": 30 * 86400}
+
+MAGIC = b"DKTA"
+LAYOUT_VERSION = 1
+HEADER = struct.Struct("<4sHH4I")
+
+# port -> archive file, for the WAN instances that keep one (see eps.py)
+archive_files = {}
+
+
+def month_start(day):
+    return datetime(day.year, day.month, 1).timestamp()
+
+
+def bucket_key(tier, start):
+    # Consecutive buckets get consecutive keys; days and months follow the
+    # local calendar, so they are not a fixed number of seconds apart
+    if tier == "days":
+        return date.fromtimestamp(start).toordinal()
+    if tier == "months":
+        day = date.fromtimestamp(start)
+        return day.year * 12 + day.month - 1
+    return int(start // RESOLUTION[tier])
+
+
+def align(timestamp, step):
+    # Floors an epoch time to a multiple of step in local time, so hour and
+    # day steps start on local hours and midnights like the stored buckets
+    offset = time.localtime(timestamp).tm_gmtoff
+    return timestamp - (timestamp + offset) % step
+
+
+def graph_buckets(root, now=None):
+    # (tier, bucket start, in, out) for every bar of a graphs.xml tree. Bars
+    # are oldest first and the last one is the current period when darkstat
+    # rendered them; p is the bar's minute / hour / day of month.
+    now = datetime.now() if now is None else now
+    for tier, unit, field in (("minutes", timedelta(minutes=1), "minute"), ("hours", timedelta(hours=1), "hour")):
+        bars = [e for element in root.iter(tier) for e in element.findall("e")]
+        if not bars:
+            continue
+        period = 60 if tier == "minutes" else 24
+        current = now.replace(second=0, microsecond=0)
+        if tier == "hours":
+            current = current.replace(minute=0)
+        last = int(bars[-1].get("p"))
+        anchor = current - unit * ((getattr(current, field) - last) % period)
+        for e in bars:
+            start = anchor - unit * ((last - int(e.get("p"))) % period)
+            yield tier, start.timestamp(), int(e.get("i")), int(e.get("o"))
+
+    bars = [e for element in root.iter("days") for e in element.findall("e")]
+    if bars:
+        today = now.date()
+        last = int(bars[-1].get("p"))
+        try:
+            if last <= today.day:
+                anchor = today.replace(day=last)
+            else:
+                # Rendered before midnight at the end of last month
+                anchor = (today.replace(day=1) - timedelta(days=1)).replace(day=last)
+        except ValueError:
+            return
+        previous_month = anchor.replace(day=1) - timedelta(days=1)
+        for e in bars:
+            day = int(e.get("p"))
+            try:
+                if day <= anchor.day:
+                    start = datetime(anchor.year, anchor.month, day)
+                else:
+                    start = datetime(previous_month.year, previous_month.month, day)
+            except ValueError:
+                # darkstat keeps 31 day slots, e.g. no 31st in a 30-day month
+                continue
+            yield "days", start.timestamp(), int(e.get("i")), int(e.get("o"))
+
+
+class TrafficArchive:
+
+    def __init__(self, path, retention=retention):
+        self.path = path
+        self.sizes = [retention[tier] for tier in TIERS]
+        if self.sizes[TIERS.index("days")] <= 31:
+            raise ValueError("The archive must keep more days than darkstat's 31")
+        self._lock = threading.Lock()
+        self._file, self._mapped = self._open()
+        self._tiers = {}
+        offset = HEADER.size
+        for tier, size in zip(TIERS, self.sizes):
+            arrays = []
+            for _ in range(3):
+                arrays.append(memoryview(self._mapped)[offset:offset + size * 8].cast("q"))
+                offset += size * 8
+            self._tiers[tier] = (size, *arrays)
+
+    def _file_size(self):
+        return HEADER.size + 3 * 8 * sum(self.sizes)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        f = os.fdopen(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644), "r+b")
+        expected = HEADER.pack(MAGIC, LAYOUT_VERSION, len(TIERS), *self.sizes)
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            header = f.read(HEADER.size)
+            if header and header != expected:
+                # Another layout or retention: keep the old file aside and start over
+                print(f"Traffic archive {self.path} has a different layout, moving it to {self.path}.old")
+                os.replace(self.path, self.path + ".old")
+            else:
+                if not header:
+                    f.truncate(self._file_size())
+                    f.write(expected)
+                    f.flush()
+                return f, mmap.mmap(f.fileno(), self._file_size())
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+        f.close()
+        return self._open()
+
+    def _add(self, tier, start, bytes_in, bytes_out):
+        # Keeps the larger of the stored and the new counts; returns how much
+        # the bucket grew, or None when the bucket is older than the ring
+        size, starts, ins, outs = self._tiers[tier]
+        slot = bucket_key(tier, start) % size
+        start = int(start)
+        if starts[slot] == start:
+            grew_in = max(bytes_in - ins[slot], 0)
+            grew_out = max(bytes_out - outs[slot], 0)
+        elif starts[slot] > start:
+            return None
+        else:
+            starts[slot] = start
+            ins[slot] = outs[slot] = 0
+            grew_in, grew_out = bytes_in, bytes_out
+        ins[slot] += grew_in
+        outs[slot] += grew_out
+        return grew_in, grew_out
+
+    def _add_to_month(self, day_start, grew_in, grew_out):
+        size, starts, ins, outs = self._tiers["months"]
+        start = int(month_start(date.fromtimestamp(day_start)))
+        slot = bucket_key("months", start) % size
+        if starts[slot] > start:
+            return
+        if starts[slot] != start:
+            starts[slot] = start
+            ins[slot] = outs[slot] = 0
+        ins[slot] += grew_in
+        outs[slot] += grew_out
+
+    def ingest(self, root, now=None):
+        # Folds one graphs.xml tree in; bars seen before only change a bucket
+        # when they grew
+        with self._lock:
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                for tier, start, bytes_in, bytes_out in graph_buckets(root, now):
+                    grew = self._add(tier, start, bytes_in, bytes_out)
+                    if tier == "days" and grew and any(grew):
+                        self._add_to_month(start, *grew)
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+    def pick_tier(self, step):
+        # The coarsest tier no coarser than step: it reaches back furthest,
+        # and hours and days are as complete as darkstat's own graphs while
+        # minutes only exist since this API has been running
+        return [tier for tier in TIERS if RESOLUTION[tier] <= step][-1]
+
+    def _buckets(self, tier, start, end):
+        # (start, in, out) of the stored buckets starting in [start, end)
+        size, starts, ins, outs = self._tiers[tier]
+        if tier in ("minutes", "hours"):
+            first = bucket_key(tier, start) - 1
+            last = bucket_key(tier, end) + 1
+            slots = (key % size for key in range(max(first, last - size + 1), last + 1))
+        else:
+            slots = range(size)
+        for slot in slots:
+            # Slots never written keep start 0
+            if starts[slot] and start <= starts[slot] < end:
+                yield starts[slot], ins[slot], outs[slot]
+
+    def query(self, start, end, step):
+        # Traffic per step seconds from start to end (epoch seconds), from
+        # the tier picked for step. A stored bucket counts towards the step it
+        # starts in; steps without any stored bucket are left out.
+        # Returns (tier, [(step start, in, out), ...]).
+        if step < RESOLUTION["minutes"]:
+            raise ValueError(f"step must be at least {RESOLUTION['minutes']} seconds")
+        if end <= start:
+            raise ValueError("to must be after from")
+        points = -(-(end - start) // step)
+        if points > max_range_points:
+            raise ValueError(f"Range has {points} steps, at most {max_range_points} are allowed")
+
+        tier = self.pick_tier(step)
+        totals_in = [0] * points
+        totals_out = [0] * points
+        seen = bytearray(points)
+        with self._lock:
+            fcntl.flock(self._file, fcntl.LOCK_SH)
+            try:
+                for bucket_start, bytes_in, bytes_out in self._buckets(tier, start, end):
+                    index = int((bucket_start - start) // step)
+                    totals_in[index] += bytes_in
+                    totals_out[index] += bytes_out
+                    seen[index] = 1
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+        return tier, [(start + index * step, totals_in[index], totals_out[index])
+                      for index in range(points) if seen[index]]
+
+    def close(self):
+        for size, *arrays in self._tiers.values():
+            for array in arrays:
+                array.release()
+        self._tiers = {}
+        self._mapped.close()
+        self._file.close()
+
+
+_archives = {}
+_archives_lock = threading.Lock()
+
+
+def get_archive(port):
+    # TrafficArchive of a WAN port, None when it keeps none
+    path = archive_files.get(port)
+    if path is None:
+        return None
+    with _archives_lock:
+        archive = _archives.get(port)
+        if archive is None:
+            archive = _archives[port] = TrafficArchive(path)
+        return archive
+
+
+def record_traffic(port, root):
+    # Called with every graphs.xml tree read for a port
+    if root is None or port not in archive_files:
+        return
+    try:
+        with timed("record_traffic", port=port):
+            get_archive(port).ingest(root)
+    except (OSError, ValueError) as e:
+        print(f"Error archiving traffic for port {port}: {e}")
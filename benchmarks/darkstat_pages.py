@@ -0,0 +1,178 @@
+import random
+import socket
+import struct
+import time
+
+
+# Synthetic pages shaped like darkstat's own /hosts/?full=yes, /hosts/<ip>/
+# and graphs.xml output, for benchmarks and the fake darkstat server.
+
+PAGE_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+<title>Hosts (darkstat)</title>
+<meta name="generator" content="darkstat 3.0.719">
+<link rel="stylesheet" href="../style.css" type="text/css">
+</head>
+<body>
+<div class="menu">
+<ul class="menu">
+<li class="label">darkstat</li>
+<li><a href="../">graphs</a></li>
+<li><a href="../hosts/">hosts</a></li>
+</ul>
+</div>
+<div class="content">
+"""
+
+PAGE_TAIL = """</div>
+</body>
+</html>
+"""
+
+
+def host_ip(index, base="10.0"):
+    # 10.0.0.1 .. 10.0.255.254, then wraps into 10.1.x.x etc.
+    index += 1
+    third, fourth = divmod(index, 254)
+    second_extra, third = divmod(third, 256)
+    first, second = base.split(".")
+    return f"{first}.{int(second) + second_extra}.{third}.{fourth + 1}"
+
+
+def host_mac(index):
+    return "02:00:%02x:%02x:%02x:%02x" % ((index >> 24) & 0xff, (index >> 16) & 0xff, (index >> 8) & 0xff, index & 0xff)
+
+
+def hosts_page(host_count, seed=0, base="10.0"):
+    rng = random.Random(seed)
+    parts = [PAGE_HEAD, "<h2 class=\"pageheader\">Hosts</h2>\n",
+             "<p>\n<b>%d</b> hosts on this network.\n</p>\n" % host_count,
+             "<table>\n<tr>\n <th>IP</th>\n <th>Hostname</th>\n <th>MAC Address</th>\n"
+             " <th><a href=\"?sort=in\">In</a></th>\n <th><a href=\"?sort=out\">Out</a></th>\n"
+             " <th><a href=\"?sort=total\">Total</a></th>\n <th>Last seen</th>\n</tr>\n"]
+
+    for index in range(host_count):
+        ip = host_ip(index, base)
+        bytes_in = rng.randrange(0, 10 ** 10)
+        bytes_out = rng.randrange(0, 10 ** 10)
+        parts.append(
+            "<tr class=\"alt%d\">\n"
+            " <td><a href=\"./%s/\">%s</a></td>\n"
+            " <td>(none)</td>\n"
+            " <td><tt>%s</tt></td>\n"
+            " <td class=\"num\">%s</td>\n"
+            " <td class=\"num\">%s</td>\n"
+            " <td class=\"num\">%s</td>\n"
+            " <td class=\"num\">%d secs</td>\n"
+            "</tr>\n" % (index % 2 + 1, ip, ip, host_mac(index),
+                         f"{bytes_in:,}", f"{bytes_out:,}", f"{bytes_in + bytes_out:,}", rng.randrange(60))
+        )
+
+    parts.append("</table>\n")
+    parts.append(PAGE_TAIL)
+    return "".join(parts)
+
+
+def _port_table(title, rows, with_syns):
+    header = " <th>Port</th>\n <th>Service</th>\n <th>In</th>\n <th>Out</th>\n <th>Total</th>\n"
+    if with_syns:
+        header += " <th>SYNs</th>\n"
+    parts = [f"<h3>{title}</h3>\n<table>\n<tr>\n{header}</tr>\n"]
+    for index, (port, service, bytes_in, bytes_out, syns) in enumerate(rows):
+        parts.append(
+            "<tr class=\"alt%d\">\n <td class=\"num\">%s</td>\n <td>%s</td>\n"
+            " <td class=\"num\">%s</td>\n <td class=\"num\">%s</td>\n <td class=\"num\">%s</td>\n"
+            % (index % 2 + 1, port, service, f"{bytes_in:,}", f"{bytes_out:,}", f"{bytes_in + bytes_out:,}")
+        )
+        if with_syns:
+            parts.append(" <td class=\"num\">%s</td>\n" % f"{syns:,}")
+        parts.append("</tr>\n")
+    parts.append("</table>\n")
+    return "".join(parts)
+
+
+def host_page(ip, mac, port_count=20, seed=0):
+    rng = random.Random(seed)
+    services = ["http", "https", "domain", "ssh", "ntp", "imaps", ""]
+
+    def port_rows():
+        return [(rng.randrange(1, 65536), rng.choice(services), rng.randrange(10 ** 8),
+                 rng.randrange(10 ** 8), rng.randrange(1000)) for _ in range(port_count)]
+
+    protocols = [(1, "icmp"), (6, "tcp"), (17, "udp")]
+    parts = [PAGE_HEAD, f"<h2 class=\"pageheader\">{ip}</h2>\n",
+             f"<p>\n<b>MAC Address:</b> <tt>{mac}</tt><br>\n",
+             "<b>Hostname:</b> (none)<br>\n",
+             "<b>Last seen:</b> 3 secs<br>\n</p>\n",
+             _port_table("TCP ports on this host", port_rows(), True),
+             _port_table("TCP ports on remote hosts", port_rows(), True),
+             _port_table("UDP ports on this host", port_rows(), False),
+             _port_table("UDP ports on remote hosts", port_rows(), False)]
+
+    parts.append("<h3>IP protocols</h3>\n<table>\n<tr>\n <th>#</th>\n <th>Protocol</th>\n"
+                 " <th>In</th>\n <th>Out</th>\n <th>Total</th>\n</tr>\n")
+    for index, (number, name) in enumerate(protocols):
+        bytes_in, bytes_out = rng.randrange(10 ** 9), rng.randrange(10 ** 9)
+        parts.append(
+            "<tr class=\"alt%d\">\n <td class=\"num\">%d</td>\n <td>%s</td>\n"
+            " <td class=\"num\">%s</td>\n <td class=\"num\">%s</td>\n <td class=\"num\">%s</td>\n</tr>\n"
+            % (index % 2 + 1, number, name, f"{bytes_in:,}", f"{bytes_out:,}", f"{bytes_in + bytes_out:,}")
+        )
+    parts.append("</table>\n")
+    parts.append(PAGE_TAIL)
+    return "".join(parts)
+
+
+def graphs_xml(seed=0):
+    rng = random.Random(seed)
+
+    def bars(tag, periods):
+        entries = "".join(
+            f"<e p=\"{period}\" i=\"{rng.randrange(10 ** 9)}\" o=\"{rng.randrange(10 ** 9)}\"/>" for period in periods
+        )
+        return f"<{tag}>{entries}</{tag}>"
+
+    return (
+        "<graphs tp0=\"0\" tp1=\"0\" tp2=\"0\" tp3=\"0\" un0=\"0\" un1=\"0\" un2=\"0\" un3=\"0\">"
+        + bars("seconds", range(60))
+        + bars("minutes", range(60))
+        + bars("hours", [(hour + 1) % 24 for hour in range(24)])
+        + bars("days", list(range(19, 29)) + list(range(1, 11)))
+        + "</graphs>"
+    )
+
+
+def export_file(host_count, port_count=20, seed=0, base="10.0", now=None):
+    # darkstat --export data for the same hosts (and counters) as hosts_page(),
+    # see exports.py for the layout
+    now = int(time.time()) if now is None else now
+    rng = random.Random(seed)
+    parts = [b"\xda\x31\x41\x59", b"\xdaHS\x01", struct.pack(">I", host_count)]
+
+    for index in range(host_count):
+        bytes_in = rng.randrange(0, 10 ** 10)
+        bytes_out = rng.randrange(0, 10 ** 10)
+        last_seen = now - rng.randrange(60)
+        port_rng = random.Random(index)
+        parts.append(b"HST\x03\x04" + socket.inet_aton(host_ip(index, base)))
+        parts.append(struct.pack(">Q", last_seen) + bytes.fromhex(host_mac(index).replace(":", "")) + b"\x00")
+        parts.append(struct.pack(">QQ", bytes_in, bytes_out))
+        parts.append(b"P" + struct.pack(">B", 3))
+        for proto in (1, 6, 17):
+            parts.append(struct.pack(">BQQ", proto, port_rng.randrange(10 ** 9), port_rng.randrange(10 ** 9)))
+        parts.append(b"T" + struct.pack(">H", port_count))
+        for _ in range(port_count):
+            parts.append(struct.pack(">HQQQ", port_rng.randrange(1, 65536), port_rng.randrange(1000),
+                                     port_rng.randrange(10 ** 8), port_rng.randrange(10 ** 8)))
+        parts.append(b"U" + struct.pack(">H", port_count))
+        for _ in range(port_count):
+            parts.append(struct.pack(">HQQ", port_rng.randrange(1, 65536), port_rng.randrange(10 ** 8), port_rng.randrange(10 ** 8)))
+
+    parts.append(b"\xdaGR\x01" + struct.pack(">Q", now))
+    for bar_count, position in ((60, now % 60), (60, now // 60 % 60), (24, time.localtime(now).tm_hour),
+                                (31, time.localtime(now).tm_mday - 1)):
+        parts.append(struct.pack(">BB", bar_count, position))
+        for _ in range(bar_count):
+            parts.append(struct.pack(">QQ", rng.randrange(10 ** 9), rng.randrange(10 ** 9)))
+    return b"".join(parts)
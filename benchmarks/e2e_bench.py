@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import httpx
+
+from darkstat import data, eps, lan
+from darkstat.benchmarks.fake_darkstat import FakeDarkstat, write_lease_file
+from darkstat.instances import Instance
+from darkstat.leases import lease_index
+
+
+# End-to-end benchmark against a fake darkstat (see fake_darkstat.py) and a
+# matching lease file. For every host count it reports latency percentiles
+# of the scraping functions and of the eps.py endpoints, endpoint throughput
+# under concurrent clients, and peak memory, then writes everything as JSON
+# so runs from different commits can be compared:
+#
+#   python -m darkstat.benchmarks.e2e_bench --hosts 1000 10000 --output new.json
+#   python -m darkstat.benchmarks.e2e_bench --hosts 1000 10000 --compare old.json
+
+
+class StaticInterfaces:
+    # Stands in for interfaces.interface_monitor: the fake hosts live in
+    # 10.0.0.0/8 on an interface that is always up
+    def is_up(self, interface_name):
+        return True
+
+    def get_subnet(self, interface_name):
+        return "10.0.0.1", 8
+
+    def get_ipv6_subnets(self, interface_name):
+        return []
+
+
+bench_interface = "bench0"
+
+ENDPOINTS = [
+    "/lan1/all_devices",
+    "/lan1/all_devices?limit=50&sort=total&fields=ip,name,total",
+    "/lan1/top_total",
+    "/lan1/top_in_rate",
+    "/wan1/minutes",
+    "/wan1/hours",
+    "/wan1/days",
+]
+
+
+def percentiles(samples):
+    # Nearest-rank percentiles, in milliseconds
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def rank(fraction):
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000
+
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": rank(0.50),
+        "p90_ms": rank(0.90),
+        "p99_ms": rank(0.99),
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def peak_memory(call):
+    tracemalloc.start()
+    call()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def time_calls(call, repeat):
+    samples = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - start_time)
+    return samples
+
+
+def bench_stages(port, repeat):
+    devices = lan.extract_data(bench_interface, port)
+    graphs = lan.load_graphs(port)
+    lan.graphs_cache.publish((port,), graphs)
+    sample_devices = iter(devices * (repeat // max(len(devices), 1) + 2))
+
+    stages = {
+        "extract_data": lambda: lan.extract_data(bench_interface, port),
+        "get_port_data": lambda: data.get_port_data(next(sample_devices), port),
+        "load_graphs": lambda: lan.load_graphs(port),
+        "minutes": lambda: lan.minutes(bench_interface, port),
+        "hours": lambda: lan.hours(bench_interface, port),
+        "days": lambda: lan.days(bench_interface, port),
+        "collect_details": lambda: data.get_top_devices_in_total(bench_interface, port, cached=False),
+    }
+
+    results = {}
+    for name, call in stages.items():
+        stage_repeat = max(1, repeat // 10) if name == "collect_details" else repeat
+        results[name] = percentiles(time_calls(call, stage_repeat))
+        results[name]["peak_bytes"] = peak_memory(call)
+        print(f"  {name:16} p50 {results[name]['p50_ms']:9.2f} ms  p99 {results[name]['p99_ms']:9.2f} ms"
+              f"  peak {results[name]['peak_bytes'] / 1024 / 1024:7.1f} MB")
+    return results
+
+
+async def bench_endpoints(port, repeat, concurrency_levels):
+    eps.instances = {"lan1": Instance("lan1", bench_interface, port, "lan"),
+                     "wan1": Instance("wan1", bench_interface, port, "wan")}
+
+    transport = httpx.ASGITransport(app=eps.app)
+    results = {}
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+
+        async def request(path):
+            start_time = time.perf_counter()
+            response = await client.get(path)
+            elapsed = time.perf_counter() - start_time
+            if response.status_code != 200:
+                raise SystemExit(f"{path}: HTTP {response.status_code} {response.text[:200]}")
+            return elapsed
+
+        for path in ENDPOINTS:
+            # Cold: the snapshot is dropped first, so the request scrapes,
+            # parses and serializes. Warm: served from the snapshot and the
+            # response cache, as when the collector is running.
+            cold = []
+            for _ in range(max(1, repeat // 10)):
+                lan.hosts_cache.invalidate(bench_interface, port)
+                lan.graphs_cache.invalidate(port)
+                cold.append(await request(path))
+            warm = [await request(path) for _ in range(repeat)]
+
+            throughput = {}
+            for concurrency in concurrency_levels:
+                total = max(repeat, concurrency * 4)
+                queue = iter(range(total))
+
+                async def worker():
+                    for _ in queue:
+                        await request(path)
+
+                start_time = time.perf_counter()
+                await asyncio.gather(*[worker() for _ in range(concurrency)])
+                throughput[str(concurrency)] = total / (time.perf_counter() - start_time)
+
+            results[path] = {"cold": percentiles(cold), "warm": percentiles(warm), "requests_per_second": throughput}
+            print(f"  {path:60} cold p50 {results[path]['cold']['p50_ms']:9.2f} ms"
+                  f"  warm p50 {results[path]['warm']['p50_ms']:7.3f} ms"
+                  f"  {max(throughput.values()):8.0f} req/s")
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.dirname(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    static_interfaces = StaticInterfaces()
+    lan.interface_monitor = static_interfaces
+    data.interface_monitor = static_interfaces
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "parameters": {"latency": args.latency, "ports": args.ports, "repeat": args.repeat,
+                       "concurrency": args.concurrency},
+        "runs": [],
+    }
+
+    with tempfile.TemporaryDirectory() as directory:
+        for host_count in args.hosts:
+            lease_index.path = write_lease_file(os.path.join(directory, f"leases-{host_count}"), host_count)
+            fake = FakeDarkstat(host_count, args.ports, args.latency).start()
+            port = str(fake.port)
+            print(f"{host_count} hosts, fake darkstat on port {port}")
+            try:
+                stages = bench_stages(port, args.repeat)
+                endpoints = asyncio.run(bench_endpoints(port, args.repeat, args.concurrency))
+            finally:
+                fake.stop()
+            report["runs"].append({"hosts": host_count, "stages": stages, "endpoints": endpoints,
+                                   "darkstat_requests": fake.requests})
+
+    report["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return report
+
+
+def compare(report, baseline):
+    # p50 of every stage and cold endpoint request, new against baseline
+    print(f"\ncompared with {baseline.get('commit')} (ratio > 1 is slower)")
+    old_runs = {run["hosts"]: run for run in baseline["runs"]}
+    for run in report["runs"]:
+        old = old_runs.get(run["hosts"])
+        if old is None:
+            continue
+        rows = [(name, result, old["stages"].get(name)) for name, result in run["stages"].items()]
+        rows += [(path, result["cold"], old["endpoints"].get(path, {}).get("cold")) for path, result in run["endpoints"].items()]
+        for name, result, old_result in rows:
+            if old_result:
+                ratio = result["p50_ms"] / old_result["p50_ms"] if old_result["p50_ms"] else float("inf")
+                print(f"  {run['hosts']:>7} {name:60} {old_result['p50_ms']:9.2f} -> {result['p50_ms']:9.2f} ms  x{ratio:.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against a fake darkstat")
+    parser.add_argument("--hosts", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--ports", type=int, default=20, help="port rows per table on host pages")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the fake darkstat adds per response")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--output", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare against")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report, json.load(f))
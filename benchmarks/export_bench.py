@@ -0,0 +1,71 @@
+import argparse
+import os
+import tempfile
+
+from darkstat import data, exports, lan
+from darkstat.benchmarks.darkstat_pages import export_file
+from darkstat.benchmarks.e2e_bench import StaticInterfaces, bench_interface, percentiles, time_calls
+from darkstat.benchmarks.fake_darkstat import FakeDarkstat
+
+
+# Compares reading darkstat's --export file with scraping its HTML/XML for
+# the same hosts: the hosts table, host detail pages and the graphs.
+#
+#   python -m darkstat.benchmarks.export_bench --sizes 1000 10000
+
+
+def run(sizes, ports, repeat, detail_hosts):
+    static_interfaces = StaticInterfaces()
+    lan.interface_monitor = static_interfaces
+    data.interface_monitor = static_interfaces
+
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            fake = FakeDarkstat(size, ports).start()
+            port = str(fake.port)
+            path = os.path.join(directory, f"darkstat-{size}.db")
+            with open(path, "wb") as f:
+                f.write(export_file(size, ports))
+            print(f"{size} hosts (export file {os.path.getsize(path) / 1024 / 1024:.1f} MB)")
+
+            try:
+                results = {}
+                for source in ("html", "export"):
+                    if source == "export":
+                        exports.export_files[port] = path
+                    else:
+                        exports.export_files.pop(port, None)
+                    devices = lan.extract_data(bench_interface, port)
+                    detail_devices = devices[:detail_hosts]
+                    results[source] = devices
+
+                    def details():
+                        for device in detail_devices:
+                            data.get_port_data(device, port)
+
+                    def hosts():
+                        # A changed file is parsed again, so measure that and not the cache
+                        exports.export_cache = exports.ExportCache()
+                        lan.extract_data(bench_interface, port)
+
+                    for name, call in (("hosts", hosts), ("details", details), ("graphs", lambda: lan.load_graphs(port))):
+                        result = percentiles(time_calls(call, repeat))
+                        print(f"  {source:6} {name:8} p50 {result['p50_ms']:9.2f} ms  p90 {result['p90_ms']:9.2f} ms")
+            finally:
+                exports.export_files.pop(port, None)
+                fake.stop()
+
+            html_counters = [(d.ip, d.bytes_in, d.bytes_out) for d in results["html"]]
+            export_counters = [(d.ip, d.bytes_in, d.bytes_out) for d in results["export"]]
+            if html_counters != export_counters:
+                raise SystemExit("export and HTML hosts disagree")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark darkstat export file reading against HTML scraping")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--ports", type=int, default=20, help="TCP and UDP ports per host")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--detail-hosts", type=int, default=50, help="host detail pages read per run")
+    args = parser.parse_args()
+    run(args.sizes, args.ports, args.repeat, args.detail_hosts)
@@ -0,0 +1,107 @@
+import argparse
+import http.server
+import threading
+import time
+
+from darkstat.benchmarks.darkstat_pages import graphs_xml, host_ip, host_mac, host_page, hosts_page
+
+
+# A stand-in darkstat instance for benchmarks: serves /hosts/?full=yes,
+# /hosts/<ip>/ and /graphs.xml built from darkstat_pages at any scale, with
+# an optional per-request delay to imitate a busy or remote darkstat.
+#
+#   python -m darkstat.benchmarks.fake_darkstat --hosts 10000 --port 5554
+
+
+class FakeDarkstat:
+
+    def __init__(self, host_count, port_count=20, latency=0.0, port=0, base="10.0"):
+        self.host_count = host_count
+        self.port_count = port_count
+        self.latency = latency  # seconds added to every response
+        self.base = base
+        self.requests = 0
+        self._hosts_page = hosts_page(host_count, base=base).encode()
+        self._graphs = graphs_xml().encode()
+        self._host_index = {host_ip(index, base): index for index in range(host_count)}
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = None
+
+    def _handler(self):
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True  # headers and body are separate writes
+
+            def do_GET(self):
+                body = fake.page(self.path)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                with fake._lock:
+                    fake.requests += 1
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "text/xml" if self.path.endswith(".xml") else "text/html")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def page(self, path):
+        if path.startswith("/hosts/?") or path == "/hosts/":
+            return self._hosts_page
+        if path.startswith("/graphs.xml"):
+            return self._graphs
+        if path.startswith("/hosts/"):
+            ip = path[len("/hosts/"):].strip("/")
+            index = self._host_index.get(ip)
+            if index is None:
+                return None
+            return host_page(ip, host_mac(index), self.port_count, seed=index).encode()
+        return None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name=f"fake-darkstat-{self.port}", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def write_lease_file(path, host_count, named_every=2, base="10.0"):
+    # dnsmasq format: expiry mac ip hostname client-id; every named_every-th host gets a name
+    with open(path, "w") as lease_file:
+        for index in range(0, host_count, named_every):
+            lease_file.write(f"{int(time.time()) + 3600} {host_mac(index)} {host_ip(index, base)} host-{index} *\n")
+    return path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve synthetic darkstat pages")
+    parser.add_argument("--hosts", type=int, default=1000)
+    parser.add_argument("--ports", type=int, default=20, help="port rows per table on host pages")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument("--port", type=int, default=5554)
+    parser.add_argument("--lease-file", help="also write a matching dnsmasq lease file here")
+    args = parser.parse_args()
+
+    if args.lease_file:
+        write_lease_file(args.lease_file, args.hosts)
+    fake = FakeDarkstat(args.hosts, args.ports, args.latency, args.port)
+    print(f"fake darkstat with {args.hosts} hosts on http://127.0.0.1:{fake.port}/")
+    try:
+        fake._server.serve_forever()
+    except KeyboardInterrupt:
+        fake.stop()
@@ -0,0 +1,63 @@
+import argparse
+import time
+import tracemalloc
+
+from darkstat.benchmarks.darkstat_pages import host_mac, host_page, hosts_page
+from darkstat.parsers import parse_host_page, parse_hosts_table
+
+
+# Parses synthetic darkstat pages with every parser backend, checks that the
+# backends agree and reports wall time and peak allocation per backend.
+#
+#   python -m darkstat.benchmarks.parser_bench --sizes 1000 10000 100000
+
+
+def measure(parse, page, repeat):
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = parse(page)
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    parse(page)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def run(sizes, backends, repeat):
+    for size in sizes:
+        page = hosts_page(size)
+        print(f"hosts table, {size} hosts ({len(page) / 1024 / 1024:.1f} MB)")
+        results = {}
+        for backend in backends:
+            result, best, peak = measure(lambda html_code: parse_hosts_table(html_code, backend), page, repeat)
+            results[backend] = result
+            print(f"  {backend:5} {best * 1000:10.1f} ms {peak / 1024 / 1024:8.1f} MB peak  {len(result)} rows")
+        check_identical("hosts table", results)
+
+    page = host_page("10.0.0.2", host_mac(1), port_count=200)
+    print(f"host page, 5 x 200 rows ({len(page) / 1024:.0f} KB)")
+    results = {}
+    for backend in backends:
+        result, best, peak = measure(lambda html_code: parse_host_page(html_code, backend), page, repeat)
+        results[backend] = result
+        print(f"  {backend:5} {best * 1000:10.1f} ms {peak / 1024 / 1024:8.1f} MB peak")
+    check_identical("host page", results)
+
+
+def check_identical(label, results):
+    outputs = list(results.values())
+    if any(output != outputs[0] for output in outputs[1:]):
+        raise SystemExit(f"{label}: parser backends disagree")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark darkstat HTML parser backends")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--backends", nargs="+", default=["bs4", "fast"])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    run(args.sizes, args.backends, args.repeat)
@@ -0,0 +1,181 @@
+import asyncio
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from darkstat.metrics import count, timed
+
+
+# HTTP access to the local darkstat instances. The eps.py routes await
+# DarkstatClient, while the background collector threads use fetch_page.
+# Both share one circuit breaker per instance: after failure_threshold
+# failed fetches in a row the instance is treated as down, and callers fail
+# fast (or get the last good page) until reset_timeout has passed and a
+# probe request succeeds.
+
+connect_timeout = 2   # seconds
+read_timeout = 10     # seconds
+retry_attempts = 3
+backoff_base = 0.25   # seconds, doubled per attempt
+backoff_max = 4       # seconds
+failure_threshold = 3
+reset_timeout = 30    # seconds an open breaker waits before letting a probe through
+pool_size = 16        # keep-alive connections per darkstat instance
+
+
+class DarkstatUnavailable(Exception):
+    pass
+
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold=failure_threshold, reset_timeout=reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: let this one request probe, hold the rest off for
+                # another reset_timeout
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(netloc):
+    with _breakers_lock:
+        return breakers.setdefault(netloc, CircuitBreaker())
+
+
+def backoff_delay(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+
+
+# Synchronous path, for the collector threads
+
+session = requests.Session()
+session.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=pool_size))
+
+
+def fetch_page(url):
+    netloc = urlsplit(url).netloc
+    port = netloc.rpartition(":")[2]
+    breaker = get_breaker(netloc)
+    if not breaker.allow():
+        count("darkstat_errors_total", port=port, reason="breaker_open")
+        raise DarkstatUnavailable(f"{url}: darkstat marked unhealthy, not retrying yet")
+
+    with timed("darkstat_fetch", port=port):
+        for attempt in range(retry_attempts):
+            try:
+                response = session.get(url, timeout=(connect_timeout, read_timeout))
+                response.raise_for_status()
+                breaker.record_success()
+                return response.text
+            except requests.exceptions.RequestException as e:
+                error = e
+                count("darkstat_errors_total", port=port, reason=type(e).__name__)
+                if attempt + 1 < retry_attempts:
+                    time.sleep(backoff_delay(attempt))
+
+    breaker.record_failure()
+    raise DarkstatUnavailable(f"{url}: {error}")
+
+
+# Asynchronous path, for the API routes
+
+class DarkstatClient:
+
+    def __init__(self, port, host="localhost"):
+        self.base_url = f"http://{host}:{port}"
+        self.port = str(port)
+        self.breaker = get_breaker(f"{host}:{port}")
+        self.last_good = {}  # path -> body of the last successful fetch
+        self._client = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            )
+        return self._client
+
+    def _stale(self, path, reason):
+        if path in self.last_good:
+            return self.last_good[path]
+        raise DarkstatUnavailable(f"{self.base_url}{path}: {reason}")
+
+    async def fetch(self, path):
+        if not self.breaker.allow():
+            count("darkstat_errors_total", port=self.port, reason="breaker_open")
+            return self._stale(path, "darkstat marked unhealthy, not retrying yet")
+
+        client = self._get_client()
+        with timed("darkstat_fetch", port=self.port):
+            for attempt in range(retry_attempts):
+                try:
+                    response = await client.get(path)
+                    response.raise_for_status()
+                    self.breaker.record_success()
+                    self.last_good[path] = response.text
+                    return response.text
+                except httpx.HTTPError as e:
+                    error = e
+                    count("darkstat_errors_total", port=self.port, reason=type(e).__name__)
+                    if attempt + 1 < retry_attempts:
+                        await asyncio.sleep(backoff_delay(attempt))
+
+        self.breaker.record_failure()
+        return self._stale(path, error)
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+clients = {}
+
+
+def get_client(port):
+    if port not in clients:
+        clients[port] = DarkstatClient(port)
+    return clients[port]
+
+
+async def close_clients():
+    for client in clients.values():
+        await client.aclose()
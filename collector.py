@@ -0,0 +1,118 @@
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from darkstat import lan
+from darkstat.exports import refresh_export
+from darkstat.instances import worker_pool
+
+
+class Collector:
+    # Runs every job once per tick on fixed wall-clock boundaries (multiples of
+    # interval seconds), all jobs in parallel. A job still running from an
+    # earlier tick is skipped rather than queued, and ticks missed while the
+    # scheduler itself was late are coalesced into the next one, so an
+    # overrunning cycle never stacks up or crashes the loop.
+
+    def __init__(self, jobs, interval=30, executor=None):
+        self.jobs = dict(jobs)  # name -> callable
+        self.interval = interval
+        self.shared_executor = executor  # run on this pool instead of one of our own
+        self.skipped = {name: 0 for name in self.jobs}
+        self.last_run = {}      # name -> (tick, seconds taken)
+        self._running = {}      # name -> Future of the in-flight run
+        self._executor = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._stop.clear()
+        if self.shared_executor is not None:
+            self._executor = self.shared_executor
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=max(len(self.jobs), 1), thread_name_prefix="collector")
+        self._thread = threading.Thread(target=self._run, name="collector", daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._executor is not None and self._executor is not self.shared_executor:
+            self._executor.shutdown(wait=wait)
+
+    def _run(self):
+        # First tick immediately so the store is filled at startup, then on the
+        # next interval boundary
+        tick = time.time()
+        while not self._stop.is_set():
+            self.run_tick(tick)
+
+            next_tick = math.floor(tick / self.interval) * self.interval + self.interval
+            now = time.time()
+            if next_tick <= now:
+                missed = int((now - next_tick) // self.interval) + 1
+                print(f"Collector fell behind, coalescing {missed} tick(s)")
+                next_tick += missed * self.interval
+            if self._stop.wait(next_tick - now):
+                break
+            tick = next_tick
+
+    def run_tick(self, tick):
+        for name, job in self.jobs.items():
+            running = self._running.get(name)
+            if running is not None and not running.done():
+                self.skipped[name] += 1
+                print(f"Collection for {name} still running, skipping this tick")
+                continue
+            self._running[name] = self._executor.submit(self._run_job, name, job, tick)
+
+    def _run_job(self, name, job, tick):
+        start_time = time.perf_counter()
+        try:
+            job()
+        except Exception as e:
+            print(f"Error collecting {name}: {e}")
+        self.last_run[name] = (tick, time.perf_counter() - start_time)
+
+
+# Called as hook(interface, port, ip_data) after every LAN collection that
+# found hosts, e.g. to index their details (see eps.py)
+after_lan_collection = []
+
+
+def collect_lan(interface, port):
+    refresh_export(port)  # read below instead of the HTML when it arrives in time
+    ip_data = lan.load_hosts(interface, port)
+    lan.hosts_cache.publish((interface, port), ip_data)
+    if ip_data:
+        for hook in after_lan_collection:
+            hook(interface, port, ip_data)
+
+
+def collect_wan(interface, port):
+    # graphs.xml changes once per darkstat minute (graphs_cache.period), so
+    # ticks in between have nothing to publish
+    if lan.graphs_cache.in_period(port):
+        return
+    refresh_export(port)
+    if lan.is_interface_up(interface):
+        lan.graphs_cache.publish((port,), lan.load_graphs(port))
+
+
+def instance_jobs(instances):
+    # instances: iterable of instances.Instance
+    collectors = {"lan": collect_lan, "wan": collect_wan}
+    return {instance.name: partial(collectors[instance.role], instance.interface, instance.port) for instance in instances}
+
+
+def start_collector(instances, interval=30):
+    # Switch the lan.py caches to publish-only so API reads never scrape
+    lan.hosts_cache.passive = True
+    lan.graphs_cache.passive = True
+    # All instances are collected on the shared worker pool
+    collector = Collector(instance_jobs(instances), interval=interval, executor=worker_pool)
+    collector.start()
+    return collector
@@ -1,149 +1,68 @@
 import time
-import re
-import requests
-import json
-import time
-from bs4 import BeautifulSoup
-import ipaddress
-import subprocess
+import os
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from darkstat.client import fetch_page
+from darkstat.collector import Collector
+from darkstat.details import DetailCache
+from darkstat.exports import get_export, host_page
+from darkstat.history import HistoryStore, history_db_path, to_epoch
+from darkstat.interfaces import interface_monitor
+from darkstat.lan import parse_hosts_data
+from darkstat.metrics import timed
+from darkstat.parsers import parse_host_page
+from darkstat.portindex import export_entries, get_port_index, record_entries
+from darkstat.rankings import HostRankings
+from darkstat.rates import PortRates
 
-lease_file_path = "/var/lib/misc/dnsmasq.leases"
-
-
-def get_subnet(interface_name):
-    try:
-        result = subprocess.run(["ip", "-j", "-o", "addr", "show", interface_name], capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
-        local_ip = data[0]["addr_info"][0]["local"]
-        prefix_len = data[0]["addr_info"][0]["prefixlen"]
-        return local_ip, prefix_len
-
-
-    except subprocess.CalledProcessError as e:
-        print(f"Error executing 'ip' command: {e}")
-        return None
-    except (json.JSONDecodeError, IndexError, KeyError) as e:
-        print(f"Error parsing JSON output: {e}")
-        return None
 
+max_workers = 8  # concurrent /hosts/<ip>/ fetches per collection cycle
+detail_top_n = 50  # hosts whose detail pages are collected each cycle
 
-def get_device_name_from_lease(ip_address, mac_address):
-    try:
-        with open(lease_file_path, 'r') as lease_file:
-            leases = lease_file.readlines()
-
-        mac_address = mac_address.lower()  # Convert MAC address to lowercase because mac address in lease file is in lowercase
-
-        for line in leases:
-            values = line.strip().split()
-            if len(values) >= 4 and values[2] == ip_address and values[1].lower() == mac_address:   # Check if IP address and MAC address match
-                device_name = values[3]
-                return device_name
-    except FileNotFoundError:
-        print(f"DHCP lease file not found: {lease_file_path}")
-    except Exception as e:
-        print(f"Error reading DHCP lease file: {e}")
-
-    return "Unknown"
-
-
-def is_ip_in_subnet(ip_address, subnet):
-    try:
-        ip_address_obj = ipaddress.ip_address(ip_address)
-        subnet_obj = ipaddress.ip_network(subnet, strict=False)
-        return ip_address_obj in subnet_obj
-    except ValueError:
-        return False
-    
 
 def refresh_page(url):
-    retry_attempts = 5
-    retry_delay = 2  # seconds
-
-    for attempt in range(retry_attempts):
-        try:
-            response = requests.get(url)
-            return response.text
-        except requests.exceptions.RequestException as e:
-            time.sleep(retry_delay)
+    return fetch_page(url)
 
 
 def is_interface_up(interface_name):
-    try:
-        result = subprocess.run(['ip', 'a', 'show', interface_name], capture_output=True, text=True)
-        # Check if the output contains 'state UP' in the status section
-        return 'state UP' in result.stdout
-    except Exception as e:
-        return False
+    return interface_monitor.is_up(interface_name)
 
 
 def individual_device_data(interface,port):
 
-    local_ip, cidr = get_subnet(interface)
-    subnet = f"{local_ip}/{cidr}"
-
-
-    network_address = ipaddress.IPv4Network(subnet, strict=False).network_address
-    broadcast_address = ipaddress.IPv4Network(subnet, strict=False).broadcast_address
-
-
-    excluded_ips = [str(network_address), str(broadcast_address), local_ip]
-
-
     html_code = refresh_page(f"http://localhost:{port}/hosts/?full=yes")
 
-
-    soup = BeautifulSoup(html_code, "html.parser")
-    ip_data = []
+    # Same subnet classification and lease naming as the lan.py views
+    return parse_hosts_data(interface, html_code)
 
 
-    for row in soup.find_all("tr", class_=re.compile("alt[12]")):
-        columns = row.find_all("td")
-        ip_link = columns[0].find('a')
-
-
-        if ip_link:
-            ip_match = re.search(r"\d+\.\d+\.\d+\.\d+", ip_link['href'])
-            if ip_match:
-                ip_address = ip_match.group()
-                if ip_address in excluded_ips:
-                    continue
-
-
-                if is_ip_in_subnet(ip_address, subnet):
-                    data = {
-                        "IP address": ip_address,
-                        "MAC address":columns[2].text.upper(),
-                        "Name":get_device_name_from_lease(ip_address, mac_address=columns[2].text),
-                        "In":int(columns[3].text.replace(",", "")),
-                        "Out":int(columns[4].text.replace(",", "")),
-                        "Total":int(columns[5].text.replace(",", "")),
-                        "Last seen": columns[6].text
-                    }
-                    ip_data.append(data)
-
-
-    return ip_data
+def get_port_data(device, port):
+    with timed("get_port_data", port=port):
+        return fetch_port_data(device, port)
 
 
-def get_port_data(device, port):
+def fetch_port_data(device, port):
 
     ip_address = device["IP address"]
 
-    data = refresh_page(f"http://localhost:{port}/hosts/{ip_address}/")
+    # darkstat's --export file when there is a fresh one, the host page otherwise
+    db = get_export(port)
+    page = host_page(db, ip_address) if db is not None else None
 
-    soup = BeautifulSoup(data, 'html.parser')
+    if page is None:
+        data = refresh_page(f"http://localhost:{port}/hosts/{ip_address}/")
 
-    #in_data = soup.find('b', text='In:').find_next('b').text.strip().replace(',', '')
-    #out_data = soup.find('b', text='Out:').find_next('b').text.strip().replace(',', '')
-    #total_data = soup.find('b', text='Total:').find_next('b').text.strip().replace(',', '')
+        with timed("parse_host_page", port=port):
+            page = parse_host_page(data)
+    tables = page['tables']
 
     result = {
         'Timestamp' : datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-        'IP Address': soup.find('h2', class_='pageheader').text.strip(),
-        'MAC Address': soup.find('b', text='MAC Address:').find_next('tt').text.strip().upper(),
+        'IP Address': page['IP Address'],
+        'MAC Address': page['MAC Address'].upper(),
         'In' : device["In"],
         'Out' : device["Out"],
         'Total' : device["Total"],
@@ -156,80 +75,37 @@ def get_port_data(device, port):
         'IP Protocols': []
     }
 
-    # Extract TCP ports on this host
-    tcp_table = soup.find('h3', text='TCP ports on this host').find_next('table')
-    rows = tcp_table.find_all('tr')[1:]  # Skip the header row
-
-    for row in rows:
-        cells = row.find_all('td')
-        port, service, in_value, out_value, total_value, syns = map(lambda x: x.text.strip(), cells)
-        
-        result['TCP ports on this host'].append({
-            'Port': port,
-            'Service': service,
-            'In': int(in_value.replace(",", "")),
-            'Out': int(out_value.replace(",", "")),
-            'Total': int(total_value.replace(",", "")),
-            'syns': syns
-        })
-
-    # Extract TCP ports on remote hosts
-    tcp_remote_table = soup.find('h3', text='TCP ports on remote hosts').find_next('table')
-    rows_remote = tcp_remote_table.find_all('tr')[1:]  # Skip the header row
-
-    for row in rows_remote:
-        cells = row.find_all('td')
-        port, service, in_value, out_value, total_value, syns = map(lambda x: x.text.strip(), cells)
-        
-        result['TCP ports on remote hosts'].append({
-            'Port': port,
-            'Service': service,
-            'In': int(in_value.replace(",", "")),
-            'Out': int(out_value.replace(",", "")),
-            'Total': int(total_value.replace(",", "")),
-            'syns': syns
-        })
-
-    # Extract UDP ports on this host
-    udp_table = soup.find('h3', text='UDP ports on this host').find_next('table')
-    rows_udp = udp_table.find_all('tr')[1:]  # Skip the header row
-
-    for row in rows_udp:
-        cells = row.find_all('td')
-        port, service, in_value, out_value, total_value = map(lambda x: x.text.strip(), cells)
-        
-        result['UDP ports on this host'].append({
-            'Port': port,
-            'Service': service,
-            'In': int(in_value.replace(",", "")),
-            'Out': int(out_value.replace(",", "")),
-            'Total': int(total_value.replace(",", ""))
-        })
-
-    # Extract UDP ports on remote hosts
-    udp_remote_table = soup.find('h3', text='UDP ports on remote hosts').find_next('table')
-    rows_udp_remote = udp_remote_table.find_all('tr')[1:]  # Skip the header row
-
-    for row in rows_udp_remote:
-        cells = row.find_all('td')
-        port, service, in_value, out_value, total_value = map(lambda x: x.text.strip(), cells)
-        
-        result['UDP ports on remote hosts'].append({
-            'Port': port,
-            'Service': service,
-            'In': int(in_value.replace(",", "")),
-            'Out': int(out_value.replace(",", "")),
-            'Total': int(total_value.replace(",", ""))
-        })
+    # Extract TCP ports on this host and on remote hosts
+    for title in ('TCP ports on this host', 'TCP ports on remote hosts'):
+        for cells in tables.get(title, []):
+            port, service, in_value, out_value, total_value, syns = cells
+
+            result[title].append({
+                'Port': port,
+                'Service': service,
+                'In': int(in_value.replace(",", "")),
+                'Out': int(out_value.replace(",", "")),
+                'Total': int(total_value.replace(",", "")),
+                'syns': syns
+            })
+
+    # Extract UDP ports on this host and on remote hosts
+    for title in ('UDP ports on this host', 'UDP ports on remote hosts'):
+        for cells in tables.get(title, []):
+            port, service, in_value, out_value, total_value = cells
+
+            result[title].append({
+                'Port': port,
+                'Service': service,
+                'In': int(in_value.replace(",", "")),
+                'Out': int(out_value.replace(",", "")),
+                'Total': int(total_value.replace(",", ""))
+            })
 
     # Extract IP protocols
-    ip_protocol_table = soup.find('h3', text='IP protocols').find_next('table')
-    rows_ip_protocol = ip_protocol_table.find_all('tr')[1:]  # Skip the header row
+    for cells in tables.get('IP protocols', []):
+        protocol, protocol_name, in_value, out_value, total_value = cells
 
-    for row in rows_ip_protocol:
-        cells = row.find_all('td')
-        protocol, protocol_name, in_value, out_value, total_value = map(lambda x: x.text.strip(), cells)
-        
         result['IP Protocols'].append({
             'Protocol Number': protocol,
             'Protocol name': protocol_name.upper(),
@@ -240,42 +116,143 @@ def get_port_data(device, port):
     return result
 
 
-def get_top_devices_in_total(interface, port):
+# Rankings, rate trackers and detail records carried across collection cycles
+# per (interface, port)
+host_rankings = {}
+port_rates = {}
+detail_caches = {}
+
+
+def get_port_data_cached(device, port, detail_cache):
+    port_data = detail_cache.lookup(device)
+    if port_data is None:
+        port_data = get_port_data(device, port)
+        detail_cache.store(device, port_data)
+    return port_data
+
+
+def get_top_devices_in_total(interface, port, workers=max_workers, n=None, cached=True, ip_data=None):
+    # ip_data: a hosts snapshot already at hand (eps.py), scraped otherwise
 
     if is_interface_up(interface):
 
-        ip_data = individual_device_data(interface, port)
-        top_in_total_devices = sorted(ip_data, key=lambda x: x["Total"], reverse=True)[:50]
-        
-        individual_data = []
-        
-        for device in top_in_total_devices:
-            port_data = get_port_data(device, port)
-            individual_data.append(port_data)
+        if ip_data is None:
+            ip_data = individual_device_data(interface, port)
+        rankings = host_rankings.setdefault((interface, port), HostRankings())
+        rankings.ingest(ip_data)
+        top_in_total_devices = rankings.top("Total", n or detail_top_n)
+
+        if cached:
+            # Only hosts whose In/Out/Total or Last seen moved are re-fetched
+            detail_cache = detail_caches.setdefault((interface, port), DetailCache())
+            detail_cache.start_cycle()
+            fetch = lambda device: get_port_data_cached(device, port, detail_cache)
+        else:
+            fetch = lambda device: get_port_data(device, port)
+
+        if workers > 1:
+            # map() yields results in submission order, so the ranking is kept
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                individual_data = list(executor.map(fetch, top_in_total_devices))
+        else:
+            individual_data = []
+
+            for device in top_in_total_devices:
+                port_data = fetch(device)
+                individual_data.append(port_data)
+
+        if cached:
+            detail_cache.retain({device["IP address"] for device in top_in_total_devices})
+
+        # Adds "In rate"/"Out rate"/"Total rate" (bytes/s) to hosts and ports
+        port_rates.setdefault((interface, port), PortRates()).annotate(individual_data, time.time())
         return individual_data
    
     return "Interface is down"
 
 
-if __name__ == "__main__":
-    try:
-        while True:
-            start_time = time.time()  
-            individual_data = get_top_devices_in_total("ens37", "5554")
+# Detail records data.py's own collector stored in the history database are
+# read back by index_port_data(); the first call looks this far back
+index_history_lookback = 3600  # seconds
+history_marks = {}  # (interface, port) -> time of the newest record indexed
+_history_store = None
 
-            json_data = json.dumps({"data":individual_data}, indent=2)
 
-            timestamp = datetime.now().strftime("%d%m%Y_%H%M%S")
-            filename = f"/home/guru/json_files/{timestamp}.json"
+def recorded_details(interface, port):
+    # Newest stored detail record per host since the last call, [] without a
+    # history database
+    global _history_store
+    if _history_store is None:
+        if not os.path.exists(history_db_path):
+            return []
+        _history_store = HistoryStore(history_db_path)
+    mark = history_marks.get((interface, port))
+    start = mark + 1 if mark is not None else int(time.time()) - index_history_lookback
+    try:
+        records = _history_store.range(start=start)
+    except sqlite3.Error as e:
+        print(f"Error reading detail records for the port index: {e}")
+        return []
+    if records:
+        history_marks[interface, port] = to_epoch(records[-1]['Timestamp'])
+    return list({record['IP Address']: record for record in records}.values())
+
+
+def index_port_data(interface, port, ip_data):
+    # Brings the port index (portindex.py) of a LAN instance up to date with a
+    # hosts snapshot without fetching any host page: from darkstat's export
+    # file when there is a fresh one (every host whose counters moved), else
+    # from the detail records the data.py collector already produced.
+    index = get_port_index(interface, port)
+    ips = {device["IP address"] for device in ip_data}
+    index.retain(ips)
+    db = get_export(port)
+
+    with timed("index_ports", interface, port):
+        if db is not None:
+            changes = [(device["IP address"], export_entries(db.hosts[device["IP address"]]),
+                        (device["In"], device["Out"], device["Total"]))
+                       for device in index.stale(ip_data) if device["IP address"] in db.hosts]
+        else:
+            changes = [(record['IP Address'], record_entries(record), None)
+                       for record in recorded_details(interface, port) if record['IP Address'] in ips]
+        index.update_many(changes)
+    return index
+
+
+def compare_collection_timing(interface, port, workers=max_workers):
+    timings = {}
+    for mode, mode_workers in (("sequential", 1), ("concurrent", workers)):
+        start_time = time.perf_counter()
+        get_top_devices_in_total(interface, port, workers=mode_workers, cached=False)
+        timings[mode] = time.perf_counter() - start_time
+
+    print(f"sequential: {timings['sequential']:.2f}s  concurrent ({workers} workers): {timings['concurrent']:.2f}s")
+    return timings
+
+
+def collect_to_history(interface, port, store):
+    individual_data = get_top_devices_in_total(interface, port)
+    if isinstance(individual_data, list):
+        stored = store.append(individual_data)
+        # This process serves no /metrics, so the cycle's detail fetches
+        # saved by the DetailCache are reported here
+        detail_cache = detail_caches[interface, port]
+        print(f"{interface}: {stored} records stored, {detail_cache.misses} host pages fetched, "
+              f"{detail_cache.hits} reused")
 
-            with open(filename, "w") as json_file:
-                json_file.write(json_data)
 
-            elapsed_time = time.time() - start_time
-            sleep_time = 30 - elapsed_time  
-            time.sleep(sleep_time)
+if __name__ == "__main__":
+    if "--timing" in sys.argv:
+        compare_collection_timing("ens37", "5554")
+        sys.exit(0)
 
+    store = HistoryStore()
+    collector = Collector({"ens37": lambda: collect_to_history("ens37", "5554", store)}, interval=30)
+    collector.start()
+    try:
+        while True:
+            time.sleep(3600)
     except KeyboardInterrupt:
-        pass
-    except Exception as e:
-        print(f"Error: {e}")
+        collector.stop(wait=False)
+        store.close()
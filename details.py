@@ -0,0 +1,94 @@
+import re
+import threading
+import time
+
+from darkstat.metrics import cache_result
+
+
+# Keeps the last parsed /hosts/<ip>/ record per host so a collection cycle only
+# re-downloads detail pages for hosts whose hosts-table summary moved.
+#
+# darkstat prints "Last seen" relative to now ("2 mins, 5 secs"), so the text
+# changes every cycle even for idle hosts. It is turned back into an absolute
+# time and compared with a small tolerance instead.
+
+last_seen_tolerance = 5  # seconds
+
+_LAST_SEEN_UNITS = {
+    "sec": 1, "secs": 1,
+    "min": 60, "mins": 60,
+    "hr": 3600, "hrs": 3600,
+    "day": 86400, "days": 86400,
+}
+_LAST_SEEN_RE = re.compile(r"(\d+)\s*([a-z]+)")
+
+
+def last_seen_seconds(text):
+    parts = _LAST_SEEN_RE.findall(text.replace(",", "").lower())
+    if not parts or any(unit not in _LAST_SEEN_UNITS for _, unit in parts):
+        return None
+    return sum(int(value) * _LAST_SEEN_UNITS[unit] for value, unit in parts)
+
+
+class DetailCache:
+
+    def __init__(self):
+        self.records = {}  # ip -> (summary, absolute last seen, detail record)
+        self.hits = 0       # detail fetches saved in the last cycle
+        self.misses = 0     # detail pages fetched in the last cycle
+        self.total_hits = 0
+        self.total_misses = 0
+        self._lock = threading.Lock()
+
+    def start_cycle(self):
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def _last_seen(self, device, now):
+        seconds = last_seen_seconds(device["Last seen"])
+        return None if seconds is None else now - seconds
+
+    def lookup(self, device, now=None):
+        # Cached detail record refreshed with the device's summary fields, or
+        # None when the page has to be fetched again
+        now = time.time() if now is None else now
+        summary = (device["In"], device["Out"], device["Total"])
+        cached = self.records.get(device["IP address"])
+
+        if cached is not None and cached[0] == summary:
+            last_seen = self._last_seen(device, now)
+            if last_seen is None or cached[1] is None:
+                unchanged = last_seen is None and cached[1] is None and device["Last seen"] == cached[2]["Last seen"]
+            else:
+                unchanged = abs(last_seen - cached[1]) <= last_seen_tolerance
+            if unchanged:
+                record = dict(cached[2])
+                for key, value in record.items():
+                    if isinstance(value, list):
+                        record[key] = [dict(row) for row in value]
+                record["Timestamp"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+                record["Name"] = device["Name"]
+                record["Last seen"] = device["Last seen"]
+                with self._lock:
+                    self.hits += 1
+                    self.total_hits += 1
+                cache_result("details", True)
+                return record
+
+        with self._lock:
+            self.misses += 1
+            self.total_misses += 1
+        cache_result("details", False)
+        return None
+
+    def store(self, device, record, now=None):
+        now = time.time() if now is None else now
+        summary = (device["In"], device["Out"], device["Total"])
+        with self._lock:
+            self.records[device["IP address"]] = (summary, self._last_seen(device, now), record)
+
+    def retain(self, ips):
+        # Forget hosts that dropped out of the collected set
+        with self._lock:
+            for ip in [ip for ip in self.records if ip not in ips]:
+                del self.records[ip]
@@ -1,133 +1,369 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from typing import Optional
+
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import asyncio
 import json
+import os
+import time
+from functools import partial
 
 
 app = FastAPI()
 
 
-from darkstat.lan import get_top_devices_in_total, get_top_devices_in_in, get_top_devices_in_out, all_devices, minutes, hours, days
-from darkstat.data import get_top_devices_in_total
+from darkstat.lan import get_top_devices_in_total, get_top_devices_in_in, get_top_devices_in_out, get_top_devices_in_rate, get_top_devices_out_rate, all_devices, list_devices, minutes, hours, days
+from darkstat.archive import align, archive_dir, archive_files
+from darkstat.client import DarkstatUnavailable, close_clients
+from darkstat.collector import after_lan_collection, start_collector
+from darkstat.data import get_top_devices_in_total as get_top_devices_details, index_port_data
+from darkstat.exports import export_files
+from darkstat.filecache import file_cache
+from darkstat.instances import load_instances, run_in_worker
+from darkstat.metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, render as render_metrics
+from darkstat.portindex import PROTOCOLS, get_port_index
+from darkstat.responses import ViewResult, dumps, response_cache
+from darkstat.shared import SharedSnapshots, enabled as shared_snapshots_enabled, sync_pool
+from darkstat.streams import StreamHub
+from darkstat.lan import is_interface_up, graphs_cache, hosts_cache, refresh_graphs_async, refresh_hosts_async, port_hosts, top_ports, traffic_range
+
+# name -> Instance, see instances.py for how to configure them
+instances = load_instances()
+export_files.update({instance.port: instance.export for instance in instances.values() if instance.export})
+# WAN traffic is kept beyond darkstat's windows for /{name}/range, see archive.py
+archive_files.update({instance.port: os.path.join(archive_dir, f"{instance.name}.traffic")
+                      for instance in instances.values() if instance.role == "wan"})
+
+collection_interval = 30  # seconds between background scrapes of every instance
+
+collector = None
+
+# With several worker processes only the elected one collects, see shared.py
+shared_snapshots = SharedSnapshots() if shared_snapshots_enabled else None
+
+# Pushes top-N changes and minute samples to /{name}/events and /{name}/ws
+stream_hub = StreamHub(instances)
+shared_sync_interval = 1  # seconds, how often followers look for new snapshots for the streams
+
+# The files /json may serve, all written by the collection scripts
+json_files = ("output.json", "Active.json", "Disconnected.json")
+
+
+def index_lan_ports(interface, port, ip_data):
+    # After each LAN collection: port index for /{name}/top_ports and
+    # /{name}/port/..., handed to the other workers in shared mode
+    index = index_port_data(interface, port, ip_data)
+    if shared_snapshots is not None:
+        shared_snapshots.publish_ports(interface, port, index)
+
+
+after_lan_collection.append(index_lan_ports)
+
+
+def run_collector():
+    global collector
+    collector = start_collector(instances.values(), interval=collection_interval)
+
+
+@app.on_event("startup")
+def start_collection():
+    # Endpoints below read what the collector publishes, they never scrape
+    if shared_snapshots is None:
+        run_collector()
+    else:
+        shared_snapshots.start(run_collector)
+        asyncio.get_event_loop().create_task(sync_shared_snapshots())
+
+
+async def sync_shared(sync, *args):
+    # Loads a newer snapshot from the leader, off the event loop since
+    # decoding and ingesting it is CPU work. The leader has nothing to load.
+    if shared_snapshots is None or shared_snapshots.is_leader:
+        return
+    await asyncio.get_running_loop().run_in_executor(sync_pool, partial(sync, *args))
+
+
+async def sync_shared_snapshots():
+    # Streams are fed by publishes; on followers those only happen when a
+    # snapshot from the leader is loaded, so look for one even without requests
+    while True:
+        await asyncio.sleep(shared_sync_interval)
+        for instance in instances.values():
+            try:
+                if instance.role == "lan":
+                    await sync_shared(shared_snapshots.sync_hosts, instance.interface, instance.port)
+                else:
+                    await sync_shared(shared_snapshots.sync_graphs, instance.port)
+            except Exception as e:
+                print(f"Error loading shared snapshot for {instance.name}: {e}")
+
+
+@app.on_event("shutdown")
+async def stop_collection():
+    if collector is not None:
+        collector.stop(wait=False)
+    if shared_snapshots is not None:
+        shared_snapshots.stop()
+    await close_clients()
+
+
+def get_instance(name, role):
+    instance = instances.get(name)
+    if instance is None or instance.role != role:
+        raise HTTPException(status_code=404, detail=f"No {role} instance named {name}")
+    return instance
+
+
+refresh_locks = {}
+
+
+async def ensure_snapshot(cache, key, refresh):
+    # Before the collector's first publish, scrape once through the async
+    # client instead of blocking a worker thread. Concurrent callers share
+    # that one scrape.
+    if cache.peek(*key) is not None:
+        return
+    if shared_snapshots is not None and not shared_snapshots.is_leader:
+        # Followers never contact darkstat, they wait for the leader's snapshot
+        raise HTTPException(status_code=503, detail="Waiting for the first snapshot of the collecting worker",
+                            headers={"Retry-After": str(shared_sync_interval)})
+    lock = refresh_locks.setdefault(key, asyncio.Lock())
+    async with lock:
+        if cache.peek(*key) is None:
+            try:
+                await refresh()
+            except DarkstatUnavailable as e:
+                raise HTTPException(status_code=503, detail=str(e))
+
+
+async def ensure_hosts(interface, port):
+    if shared_snapshots is not None:
+        await sync_shared(shared_snapshots.sync_hosts, interface, port)
+    await ensure_snapshot(hosts_cache, (interface, port), lambda: refresh_hosts_async(interface, port))
+
+
+async def ensure_graphs(interface, port):
+    if shared_snapshots is not None:
+        await sync_shared(shared_snapshots.sync_graphs, port)
+    if is_interface_up(interface):
+        await ensure_snapshot(graphs_cache, (port,), lambda: refresh_graphs_async(port))
+
+
+def device_listing(request, interface, port, limit, offset, cursor, sort, fields, ip, mac, name):
+    # Without any listing parameter this is the plain all_devices view
+    if not any(value is not None for value in (limit, cursor, sort, fields, ip, mac, name)) and not offset:
+        return response_cache.respond(request, request.url.path, hosts_cache.version(interface, port),
+                                      lambda: all_devices(interface, port))
+
+    if cursor is not None:
+        try:
+            offset = int(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    def build():
+        page, total = list_devices(interface, port, limit=limit, offset=offset, sort=sort, fields=fields,
+                                   ip_prefix=ip, mac_prefix=mac, name_prefix=name)
+        headers = {"X-Total-Count": str(total)}
+        if limit is not None and offset + limit < total:
+            # Cursors are the offset of the next page; treat them as opaque
+            headers["X-Next-Cursor"] = str(offset + limit)
+        return ViewResult(page, headers)
+
+    view = f"{request.url.path}?{request.url.query}"
+    try:
+        return response_cache.respond(request, view, hosts_cache.version(interface, port), build)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def graphs_version(interface, port):
+    # WAN views also depend on the link state ("Interface is down")
+    version = graphs_cache.version(port)
+    if version is None:
+        return None
+    return f"{version}-{int(is_interface_up(interface))}"
+
+
+async def lan_view(request, instance_name, build):
+    instance = get_instance(instance_name, "lan")
+    await ensure_hosts(instance.interface, instance.port)
+    return response_cache.respond(request, request.url.path, hosts_cache.version(instance.interface, instance.port),
+                                  lambda: build(instance.interface, instance.port))
 
-lan1 = "enp3s0"
-lan1_port  = "5554"
-lan2 = "enp4s0"
-lan2_port = "20000"
 
-wan1 = "enp1s0"
-wan1_port = "5555"
-wan2 = "enp2s0"
-wan2_port = "40000"
+async def wan_view(request, instance_name, build):
+    instance = get_instance(instance_name, "wan")
+    await ensure_graphs(instance.interface, instance.port)
+    return response_cache.respond(request, request.url.path, graphs_version(instance.interface, instance.port),
+                                  lambda: build(instance.interface, instance.port) or "No data found")
 
 
-@app.get("/lan1/all_devices")
-def get_all_devices():
-    json_data = all_devices(lan1,lan1_port)
-    return json_data
+@app.get("/{instance_name}/all_devices")
+async def get_all_devices(request: Request, instance_name: str, limit: Optional[int] = Query(None, ge=1),
+                          offset: int = Query(0, ge=0), cursor: Optional[str] = None, sort: Optional[str] = None,
+                          fields: Optional[str] = None, ip: Optional[str] = None, mac: Optional[str] = None,
+                          name: Optional[str] = None):
+    instance = get_instance(instance_name, "lan")
+    await ensure_hosts(instance.interface, instance.port)
+    return device_listing(request, instance.interface, instance.port, limit, offset, cursor, sort, fields, ip, mac, name)
 
 
-@app.get("/lan1/top_in")
-def get_top_devices_in():
-    top_in_devices = get_top_devices_in_in(lan1,lan1_port)
-    return top_in_devices
+@app.get("/{instance_name}/top_in")
+async def get_top_devices_in(request: Request, instance_name: str):
+    return await lan_view(request, instance_name, get_top_devices_in_in)
 
 
-@app.get("/lan1/top_out")
-def get_top_devices_out():
-    top_out_devices = get_top_devices_in_out(lan1,lan1_port)
-    return top_out_devices
+@app.get("/{instance_name}/top_out")
+async def get_top_devices_out(request: Request, instance_name: str):
+    return await lan_view(request, instance_name, get_top_devices_in_out)
 
 
-@app.get("/lan1/top_total")
-def get_top_devices_total():
-    top_total_devices = get_top_devices_in_total(lan1,lan1_port)
-    return top_total_devices
+@app.get("/{instance_name}/top_total")
+async def get_top_devices_total(instance_name: str):
+    # The detailed records of data.py (top hosts with their port and protocol
+    # tables), as this route always served. The hosts come from the snapshot;
+    # only detail pages whose host's counters moved are fetched (DetailCache).
+    instance = get_instance(instance_name, "lan")
+    await ensure_hosts(instance.interface, instance.port)
+    ip_data = hosts_cache.peek(instance.interface, instance.port)
+    try:
+        return await run_in_worker(partial(get_top_devices_details, instance.interface, instance.port, ip_data=ip_data))
+    except DarkstatUnavailable as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+
+@app.get("/{instance_name}/top_total_summary")
+async def get_top_devices_total_summary(request: Request, instance_name: str):
+    return await lan_view(request, instance_name, get_top_devices_in_total)
+
 
+@app.get("/{instance_name}/top_in_rate")
+async def get_top_devices_in_rate_view(request: Request, instance_name: str):
+    return await lan_view(request, instance_name, get_top_devices_in_rate)
 
-@app.get("/lan2/all_devices")
-def get_all_devices():
-    json_data = all_devices(lan2,lan2_port)
-    return json_data
 
+@app.get("/{instance_name}/top_out_rate")
+async def get_top_devices_out_rate_view(request: Request, instance_name: str):
+    return await lan_view(request, instance_name, get_top_devices_out_rate)
 
-@app.get("/lan2/top_in")
-def get_top_devices_in():
-    top_in_devices = get_top_devices_in_in(lan2,lan2_port)
-    return top_in_devices
 
+PORT_SORT_FIELDS = {"in": "In", "out": "Out", "total": "Total"}
 
-@app.get("/lan2/top_out")
-def get_top_devices_out():
-    top_out_devices = get_top_devices_in_out(lan2,lan2_port)
-    return top_out_devices
 
+async def port_view(request, instance_name, build):
+    # Built from the port index and, for host names, the hosts snapshot
+    instance = get_instance(instance_name, "lan")
+    await ensure_hosts(instance.interface, instance.port)
+    if shared_snapshots is not None:
+        await sync_shared(shared_snapshots.sync_ports, instance.interface, instance.port)
+    index_version = get_port_index(instance.interface, instance.port).version
+    hosts_version = hosts_cache.version(instance.interface, instance.port)
+    version = None if index_version is None or hosts_version is None else f"{hosts_version}-{index_version}"
+    view = f"{request.url.path}?{request.url.query}"
+    return response_cache.respond(request, view, version, lambda: build(instance.interface, instance.port))
 
-@app.get("/lan2/top_total")
-def get_top_devices_total():
-    top_total_devices = get_top_devices_in_total(lan2,lan2_port)
-    return top_total_devices
 
+@app.get("/{instance_name}/top_ports")
+async def get_top_ports(request: Request, instance_name: str, limit: Optional[int] = Query(None, ge=1),
+                        sort: str = "total", protocol: Optional[str] = None):
+    if sort not in PORT_SORT_FIELDS:
+        raise HTTPException(status_code=400, detail=f"Unknown sort field: {sort}")
+    if protocol is not None and protocol not in PROTOCOLS:
+        raise HTTPException(status_code=400, detail=f"Unknown protocol: {protocol}")
+    return await port_view(request, instance_name,
+                           lambda interface, port: top_ports(interface, port, PORT_SORT_FIELDS[sort], limit, protocol))
 
-@app.get("/wan1/minutes")
-def minute():
-    data = minutes(wan1,wan1_port)
-    if data:
-        return data
-    return "No data found"
 
+@app.get("/{instance_name}/port/{protocol}/{number}/hosts")
+async def get_port_hosts(request: Request, instance_name: str, protocol: str, number: int,
+                         limit: Optional[int] = Query(None, ge=1)):
+    if protocol not in PROTOCOLS:
+        raise HTTPException(status_code=400, detail=f"Unknown protocol: {protocol}")
+    return await port_view(request, instance_name,
+                           lambda interface, port: port_hosts(interface, port, protocol, number, limit))
 
-@app.get("/wan1/hours")
-def hour():
-    data = hours(wan1,wan1_port)
-    if data:
-        return data
-    return "No data found"
 
+@app.get("/{instance_name}/minutes")
+async def minute(request: Request, instance_name: str):
+    return await wan_view(request, instance_name, minutes)
 
-@app.get("/wan1/days")
-def day():
-    data = days(wan1,wan1_port)
-    if data:
-      return data
-    return "No data found"
 
+@app.get("/{instance_name}/hours")
+async def hour(request: Request, instance_name: str):
+    return await wan_view(request, instance_name, hours)
 
-@app.get("/wan2/minutes")
-def minute():
-    data = minutes(wan2,wan2_port)
-    if data:
-        return data
-    return "No data found"
 
+@app.get("/{instance_name}/days")
+async def day(request: Request, instance_name: str):
+    return await wan_view(request, instance_name, days)
 
-@app.get("/wan2/hours")
-def hour():
-    data = hours(wan2,wan2_port)
-    if data:
-        return data
-    return "No data found"
 
+@app.get("/{instance_name}/range")
+async def traffic_archive(request: Request, instance_name: str, start: Optional[int] = Query(None, alias="from"),
+                          end: Optional[int] = Query(None, alias="to"), step: int = Query(3600, ge=60)):
+    # from/to are epoch seconds, by default the last 24 hours; step in seconds
+    instance = get_instance(instance_name, "wan")
+    if instance.port not in archive_files:
+        raise HTTPException(status_code=404, detail=f"No traffic archive for {instance_name}")
+    await ensure_graphs(instance.interface, instance.port)
+    # Whole steps only, so stored buckets are not split across steps
+    end = align(int(time.time()) if end is None else end, step)
+    start = align(end - 86400 if start is None else start, step)
+
+    def build():
+        result = traffic_range(instance.port, start, end, step)
+        if result is None:
+            raise HTTPException(status_code=404, detail=f"No traffic archive for {instance_name}")
+        rows, tier = result
+        return ViewResult(rows, {"X-Archive-Tier": tier})
+
+    view = f"{request.url.path}?{request.url.query}"
+    try:
+        return response_cache.respond(request, view, graphs_version(instance.interface, instance.port), build)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
-@app.get("/wan2/days")
-def day():
-    data = days(wan2,wan2_port)
-    if data:
-        return data
-    return "No data found"
 
-@app.get("/demo")
-def data():
-    data = get_top_devices_in_total("ens37","5554")
-    return data
+@app.get("/{instance_name}/events")
+async def stream_events(instance_name: str):
+    # Server-Sent Events; a dropped client ends the response, EventSource reconnects
+    if instance_name not in instances:
+        raise HTTPException(status_code=404, detail=f"No instance named {instance_name}")
+
+    async def events():
+        async for message in stream_hub.messages(instance_name):
+            yield b": keepalive\n\n" if message is None else b"data: " + message + b"\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.websocket("/{instance_name}/ws")
+async def stream_websocket(websocket: WebSocket, instance_name: str):
+    if instance_name not in instances:
+        await websocket.close(code=1008)
+        return
+    await websocket.accept()
+    try:
+        async for message in stream_hub.messages(instance_name):
+            await websocket.send_text('{"type":"keepalive"}' if message is None else message.decode())
+        # Fell too far behind, the client should reconnect
+        await websocket.close(code=1013)
+    except WebSocketDisconnect:
+        pass
+
+
+@app.get("/metrics")
+def get_metrics():
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
 
 
 @app.get("/display")
 def display_json():
     try:
         # Replace 'output.json' with the actual file name
-        with open('output.json', 'r') as json_file:
-            data = json_file.read()
-            return JSONResponse(content=data, status_code=200, media_type="application/json")
+        return Response(file_cache.get('output.json').raw, status_code=200, media_type="application/json")
     except FileNotFoundError:
         return JSONResponse(content={"error": "File not found"}, status_code=404)
     except Exception as e:
@@ -135,10 +371,12 @@ def display_json():
 
 @app.get("/json")    
 def read_json_file(filename='output.json'):
+    if filename not in json_files:
+        raise HTTPException(status_code=404, detail="File not found")
     try:
-        with open(filename, 'r') as json_file:
-            data = json.load(json_file)
-            return data
+        cached = file_cache.get(filename)
+        cached.data  # only serve files that parse
+        return Response(cached.raw, status_code=200, media_type="application/json")
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found")
     except json.JSONDecodeError:
@@ -147,33 +385,28 @@ def read_json_file(filename='output.json'):
 @app.get("/active")
 def read_active():
     try:
-        with open("Active.json", "r") as file:
-            data = json.load(file)
-        return JSONResponse(content=data, status_code=200)
+        return Response(file_cache.get("Active.json").raw, status_code=200, media_type="application/json")
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Active.json not found")
 
 @app.get("/disconnected")
 def read_disconnected():
     try:
-        with open("Disconnected.json", "r") as file:
-            data = json.load(file)
-        return JSONResponse(content=data, status_code=200)
+        return Response(file_cache.get("Disconnected.json").raw, status_code=200, media_type="application/json")
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Disconnected.json not found")
 
+
+def merge_active_and_disconnected(active_file, disconnected_file):
+    current_data = active_file.data.get("Active Devices", [])
+    disconnected_data = disconnected_file.data.get("Disconnected Devices", [])
+    return dumps({"Active Devices": current_data, "Disconnected Devices": disconnected_data})
+
+
 @app.get("/all")
 def read_all():
     try:
-        current_data = []
-        with open("Active.json", "r") as active_file:
-            current_data = json.load(active_file).get("Active Devices", [])
-
-        disconnected_data = []
-        with open("Disconnected.json", "r") as disconnected_file:
-            disconnected_data = json.load(disconnected_file).get("Disconnected Devices", [])
-
-        return JSONResponse(content={"Active Devices": current_data, "Disconnected Devices": disconnected_data},
-                            status_code=200)
+        body = file_cache.derived("all", ["Active.json", "Disconnected.json"], merge_active_and_disconnected)
+        return Response(body, status_code=200, media_type="application/json")
     except FileNotFoundError:
-        raise HTTPException(status_code=404, detail="Files not found")
\ No newline at end of file
+        raise HTTPException(status_code=404, detail="Files not found")
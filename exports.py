@@ -0,0 +1,449 @@
+import mmap
+import os
+import signal
+import socket
+import struct
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+
+# Reader for the database darkstat writes with --export (on shutdown and on
+# SIGUSR2; SIGUSR1 would reset its counters instead). Hosts, their IP
+# protocol and TCP/UDP port tables and the graph series are read straight from the file through mmap and turned into the
+# same shapes the HTML parsers produce: hosts-table rows for
+# lan.parse_hosts_data, host pages for data.get_port_data and a graphs.xml
+# tree for lan.extract_graphs. Whenever no export is configured for a port,
+# the file is older than max_export_age or it does not parse, callers fall
+# back to scraping HTML.
+#
+# darkstat never exports on its own while running, so the collector calls
+# refresh_export() at the start of every cycle: it sends SIGUSR2 to the
+# darkstat process serving the port (found through /proc by its -p/--port
+# argument) and waits up to export_wait seconds for the file to be rewritten.
+# Until it is, get_export() ignores the previous file, so a cycle never
+# serves data one interval old as current. Signalling needs the API to run as
+# root or as the user darkstat drops privileges to; without it the export
+# goes stale and the HTML is scraped as before.
+#
+# Format (big-endian):
+#   file header      DA 31 41 59
+#   hosts section    DA 'H' 'S' 01, u32 host count, then per host:
+#     'H' 'S' 'T' v  v = 1..3
+#     v3: u8 family (4 or 6) + 4/16 address bytes; v1/v2: 4 address bytes
+#     v2+: u64 last seen (unix time)
+#     6 bytes MAC, u8 hostname length + hostname, u64 in, u64 out
+#     optional 'P' u8 count, (u8 proto, u64 in, u64 out) each
+#     optional 'T' u16 count, (u16 port, u64 syn, u64 in, u64 out) each
+#     optional 'U' u16 count, (u16 port, u64 in, u64 out) each
+#   graphs section   DA 'G' 'R' 01, u64 last update time, then for the
+#     seconds, minutes, hours and days graphs: u8 bars, u8 position of the
+#     newest bar, (u64 in, u64 out) per bar
+
+max_export_age = 90  # seconds; older exports are ignored in favour of HTML
+export_files = {}    # darkstat port -> path of its --export file
+export_wait = 2      # seconds refresh_export() waits for darkstat to write the file
+export_poll_interval = 0.05
+default_darkstat_port = "667"  # darkstat's web port when started without -p
+
+FILE_HEADER = b"\xda\x31\x41\x59"
+HOSTS_TAG = b"\xdaHS\x01"
+HOST_TAG = b"HST"
+GRAPHS_TAG = b"\xdaGR\x01"
+GRAPH_NAMES = ("seconds", "minutes", "hours", "days")
+
+_U8 = struct.Struct(">B")
+_U16 = struct.Struct(">H")
+_U32 = struct.Struct(">I")
+_U64 = struct.Struct(">Q")
+_PROTO = struct.Struct(">BQQ")
+_TCP_PORT = struct.Struct(">HQQQ")
+_UDP_PORT = struct.Struct(">HQQ")
+_BAR = struct.Struct(">QQ")
+_HOST_V2 = struct.Struct(">Q6sB")   # last seen, MAC, hostname length
+_HOST_V1 = struct.Struct(">6sB")
+_COUNTERS = struct.Struct(">QQ")
+
+
+class ExportError(Exception):
+    pass
+
+
+class ExportHost:
+    # The protocol and port tables are kept as raw bytes and only decoded
+    # when a host page is asked for, so the hosts scan skips over them
+    __slots__ = ("ip", "mac", "hostname", "last_seen", "bytes_in", "bytes_out", "_tables", "_raw_tables")
+
+    def __init__(self, ip, mac, hostname, last_seen, bytes_in, bytes_out, raw_tables=b""):
+        self.ip = ip
+        self.mac = mac
+        self.hostname = hostname
+        self.last_seen = last_seen  # unix time, None for version 1 records
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self._raw_tables = raw_tables
+        self._tables = None
+
+    def tables(self):
+        # ([(proto, in, out)], [(port, syn, in, out)], [(port, in, out)])
+        if self._tables is None:
+            ip_protocols, tcp_ports, udp_ports = [], [], []
+            raw = self._raw_tables
+            offset = 0
+            for tag, count_layout, layout, rows in ((b"P", _U8, _PROTO, ip_protocols), (b"T", _U16, _TCP_PORT, tcp_ports),
+                                                    (b"U", _U16, _UDP_PORT, udp_ports)):
+                if raw[offset:offset + 1] == tag:
+                    count, = count_layout.unpack_from(raw, offset + 1)
+                    offset += 1 + count_layout.size
+                    rows.extend(layout.iter_unpack(raw[offset:offset + count * layout.size]))
+                    offset += count * layout.size
+            self._tables = (ip_protocols, tcp_ports, udp_ports)
+        return self._tables
+
+    @property
+    def ip_protocols(self):
+        return self.tables()[0]
+
+    @property
+    def tcp_ports(self):
+        return self.tables()[1]
+
+    @property
+    def udp_ports(self):
+        return self.tables()[2]
+
+
+class ExportDB:
+    def __init__(self, hosts, graphs, last_time):
+        self.hosts = hosts          # ip -> ExportHost, in file order
+        self.graphs = graphs        # name -> (position, [(in, out), ...])
+        self.last_time = last_time  # when darkstat last updated the graphs
+
+
+class _Reader:
+    # Cursor over the mapped file
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.offset = 0
+
+    def take(self, size):
+        if self.offset + size > len(self.buffer):
+            raise ExportError(f"truncated at offset {self.offset}")
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset += size
+        return data
+
+    def unpack(self, layout):
+        if self.offset + layout.size > len(self.buffer):
+            raise ExportError(f"truncated at offset {self.offset}")
+        values = layout.unpack_from(self.buffer, self.offset)
+        self.offset += layout.size
+        return values
+
+    def peek(self, size):
+        return self.buffer[self.offset:self.offset + size]
+
+    def skip_table(self, tag, count_layout, row_size):
+        # Step over an optional tagged table, True if it was there
+        if self.peek(1) != tag:
+            return False
+        self.offset += 1
+        count, = self.unpack(count_layout)
+        self.take(count * row_size)
+        return True
+
+
+def _read_host(reader, version):
+    if version >= 3:
+        family, = reader.unpack(_U8)
+        if family == 4:
+            ip = socket.inet_ntop(socket.AF_INET, reader.take(4))
+        elif family == 6:
+            ip = socket.inet_ntop(socket.AF_INET6, reader.take(16))
+        else:
+            raise ExportError(f"unknown address family {family}")
+    else:
+        ip = socket.inet_ntop(socket.AF_INET, reader.take(4))
+    if version >= 2:
+        last_seen, mac, length = reader.unpack(_HOST_V2)
+    else:
+        last_seen = None
+        mac, length = reader.unpack(_HOST_V1)
+    hostname = reader.take(length).decode("utf-8", "replace") if length else None
+    bytes_in, bytes_out = reader.unpack(_COUNTERS)
+
+    start = reader.offset
+    reader.skip_table(b"P", _U8, _PROTO.size)
+    reader.skip_table(b"T", _U16, _TCP_PORT.size)
+    reader.skip_table(b"U", _U16, _UDP_PORT.size)
+    return ExportHost(ip, mac.hex(":"), hostname, last_seen, bytes_in, bytes_out, reader.buffer[start:reader.offset])
+
+
+def parse_export(buffer):
+    reader = _Reader(buffer)
+    if reader.take(4) != FILE_HEADER:
+        raise ExportError("not a darkstat export file")
+
+    hosts = {}
+    graphs = {}
+    last_time = None
+    while reader.offset < len(buffer):
+        tag = reader.take(4)
+        if tag == HOSTS_TAG:
+            count, = reader.unpack(_U32)
+            for _ in range(count):
+                host_tag = reader.take(4)
+                if host_tag[:3] != HOST_TAG or not 1 <= host_tag[3] <= 3:
+                    raise ExportError(f"bad host record at offset {reader.offset - 4}")
+                host = _read_host(reader, host_tag[3])
+                hosts[host.ip] = host
+        elif tag == GRAPHS_TAG:
+            last_time, = reader.unpack(_U64)
+            for name in GRAPH_NAMES:
+                bar_count, position = reader.unpack(_U8)[0], reader.unpack(_U8)[0]
+                graphs[name] = (position, [reader.unpack(_BAR) for _ in range(bar_count)])
+        else:
+            raise ExportError(f"unknown section {tag.hex()} at offset {reader.offset - 4}")
+    return ExportDB(hosts, graphs, last_time)
+
+
+def read_export(path):
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return parse_export(mapped)
+
+
+class ExportCache:
+    # Parsed export per path, re-read only when the file changes
+
+    def __init__(self):
+        self._entries = {}  # path -> (stamp, ExportDB)
+        self._lock = threading.Lock()
+
+    def get(self, path, max_age=None, outdated=None):
+        # outdated: stamp of a file known to be superseded, treated as missing
+        max_age = max_export_age if max_age is None else max_age
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if time.time() - st.st_mtime > max_age:
+            return None
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stamp == outdated:
+            return None
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == stamp:
+            return entry[1]
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry[0] == stamp:
+                return entry[1]
+            try:
+                db = read_export(path)
+            except (OSError, ValueError, ExportError) as e:
+                print(f"Error reading darkstat export {path}: {e}")
+                return None
+            self._entries[path] = (stamp, db)
+            return db
+
+
+export_cache = ExportCache()
+
+
+def get_export(port):
+    # Fresh export of the darkstat instance on port, or None to scrape instead
+    path = export_files.get(str(port))
+    if path is None:
+        return None
+    return export_cache.get(path, outdated=_requested.get(str(port)))
+
+
+_darkstat_pids = {}  # port -> pid last signalled
+_requested = {}      # port -> stamp of the export file when a new one was last requested
+_export_errors = set()  # ports whose signal or wait failure was already logged
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def darkstat_pid(port, proc="/proc"):
+    # pid of the darkstat process serving its web pages on port, or None
+    port = str(port)
+    for entry in os.listdir(proc):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc, entry, "cmdline"), "rb") as f:
+                argv = f.read().decode(errors="replace").split("\0")
+        except OSError:
+            continue
+        if os.path.basename(argv[0]) != "darkstat":
+            continue
+        served = default_darkstat_port
+        for i, arg in enumerate(argv[:-1]):
+            if arg in ("-p", "--port"):
+                served = argv[i + 1]
+        if served == port:
+            return int(entry)
+    return None
+
+
+def request_export(port):
+    # Asks darkstat on port to rewrite its export file, see the top of this
+    # module. Does nothing for ports without an export file.
+    port = str(port)
+    if port not in export_files:
+        return False
+    for attempt in range(2):
+        pid = _darkstat_pids.get(port)
+        if pid is None:
+            pid = _darkstat_pids[port] = darkstat_pid(port)
+        if pid is None:
+            error = "no darkstat process found"
+            break
+        try:
+            os.kill(pid, signal.SIGUSR2)
+            return True
+        except ProcessLookupError:
+            _darkstat_pids.pop(port, None)  # restarted, look it up again
+            error = f"process {pid} is gone"
+        except PermissionError:
+            error = f"not allowed to signal process {pid}"
+            break
+    if port not in _export_errors:
+        _export_errors.add(port)
+        print(f"Cannot request an export from darkstat on port {port}: {error}")
+    return False
+
+
+def refresh_export(port, timeout=None):
+    # Requests a new export and waits, at most timeout seconds, until darkstat
+    # has written it: the file changed and then stayed the same for one poll.
+    # False when the request or the wait failed; get_export() then returns
+    # None until the new file shows up.
+    port = str(port)
+    path = export_files.get(port)
+    if path is None:
+        return False
+    timeout = export_wait if timeout is None else timeout
+    before = _file_stamp(path)
+    if not request_export(port):
+        _requested.pop(port, None)  # no new export coming, max_export_age decides
+        return False
+    _requested[port] = before
+    deadline = time.monotonic() + timeout
+    last = before
+    while time.monotonic() < deadline:
+        time.sleep(export_poll_interval)
+        stamp = _file_stamp(path)
+        if stamp is not None and stamp != before and stamp == last:
+            _export_errors.discard(port)
+            return True
+        last = stamp
+    if port not in _export_errors:
+        _export_errors.add(port)
+        print(f"darkstat on port {port} did not write {path} within {timeout}s, scraping instead")
+    return False
+
+
+def length_of_time(seconds):
+    # darkstat's own "1 day, 2 hrs, 3 mins, 4 secs" style
+    parts = []
+    for unit, size in (("day", 86400), ("hr", 3600), ("min", 60)):
+        value, seconds = divmod(seconds, size)
+        if value or parts:
+            parts.append(f"{value} {unit}{'' if value == 1 else 's'}")
+    parts.append(f"{seconds} sec{'' if seconds == 1 else 's'}")
+    return ", ".join(parts)
+
+
+def hosts_table_rows(db, now=None):
+    # [(ip, cells)] with the cells of darkstat's hosts table:
+    # IP, hostname, MAC, In, Out, Total, Last seen
+    now = time.time() if now is None else now
+    rows = []
+    for host in db.hosts.values():
+        if not host.last_seen:
+            last_seen = "(never)"
+        else:
+            last_seen = length_of_time(max(0, int(now - host.last_seen)))
+        rows.append((host.ip, [host.ip, host.hostname or "(none)", host.mac, str(host.bytes_in),
+                               str(host.bytes_out), str(host.bytes_in + host.bytes_out), last_seen]))
+    return rows
+
+
+_services = {}
+_protocols = None
+
+
+def service_name(port, protocol):
+    key = (port, protocol)
+    if key not in _services:
+        try:
+            _services[key] = socket.getservbyport(port, protocol)
+        except OSError:
+            _services[key] = ""
+    return _services[key]
+
+
+def protocol_name(number):
+    global _protocols
+    if _protocols is None:
+        protocols = {1: "icmp", 2: "igmp", 6: "tcp", 17: "udp", 41: "ipv6", 47: "gre", 50: "esp", 58: "ipv6-icmp"}
+        try:
+            with open("/etc/protocols", "r") as f:
+                for line in f:
+                    values = line.split("#", 1)[0].split()
+                    if len(values) >= 2 and values[1].isdigit():
+                        protocols[int(values[1])] = values[0]
+        except OSError:
+            pass
+        _protocols = protocols
+    return _protocols.get(number, "")
+
+
+def host_page(db, ip):
+    # Same shape as parsers.parse_host_page, None if the host is not exported.
+    # The export has no remote-port tables, those stay empty.
+    host = db.hosts.get(ip)
+    if host is None:
+        return None
+    tables = {
+        "TCP ports on this host": [
+            [str(port), service_name(port, "tcp"), str(bytes_in), str(bytes_out), str(bytes_in + bytes_out), str(syn)]
+            for port, syn, bytes_in, bytes_out in host.tcp_ports
+        ],
+        "UDP ports on this host": [
+            [str(port), service_name(port, "udp"), str(bytes_in), str(bytes_out), str(bytes_in + bytes_out)]
+            for port, bytes_in, bytes_out in host.udp_ports
+        ],
+        "IP protocols": [
+            [str(proto), protocol_name(proto), str(bytes_in), str(bytes_out), str(bytes_in + bytes_out)]
+            for proto, bytes_in, bytes_out in host.ip_protocols
+        ],
+    }
+    return {"IP Address": host.ip, "MAC Address": host.mac, "tables": tables}
+
+
+def graphs_root(db):
+    # A graphs.xml tree as darkstat renders it: every graph oldest bar first,
+    # p is the bar's slot (second, minute, hour, day of month)
+    if not db.graphs:
+        return None
+    root = ET.Element("graphs")
+    for name in GRAPH_NAMES:
+        position, bars = db.graphs[name]
+        element = ET.SubElement(root, name)
+        offset = 1 if name == "days" else 0
+        for step in range(1, len(bars) + 1):
+            slot = (position + step) % len(bars)
+            bytes_in, bytes_out = bars[slot]
+            ET.SubElement(element, "e", p=str(slot + offset), i=str(bytes_in), o=str(bytes_out))
+    return root
@@ -0,0 +1,88 @@
+import json
+import os
+import threading
+from collections import OrderedDict
+
+
+# Keeps the JSON files served by eps.py in memory. Each request costs one
+# stat(); the file is only read again when its inode, mtime or size changed.
+# The raw bytes are served as-is, the parsed object is built on first use.
+# Only files that could be read are kept, at most max_files of them, least
+# recently used out first.
+
+max_files = 32
+
+_UNPARSED = object()
+
+
+class CachedFile:
+
+    def __init__(self, path):
+        self.path = path
+        self.stamp = None
+        self.raw = None
+        self._data = _UNPARSED
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        st = os.stat(self.path)  # FileNotFoundError goes to the caller
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if stamp == self.stamp:
+            return self
+        with self._lock:
+            if stamp != self.stamp:
+                with open(self.path, "rb") as f:
+                    self.raw = f.read()
+                self._data = _UNPARSED
+                self.stamp = stamp
+        return self
+
+    @property
+    def data(self):
+        # Parsed JSON, raises json.JSONDecodeError for a malformed file
+        if self._data is _UNPARSED:
+            self._data = json.loads(self.raw)
+        return self._data
+
+
+class FileCache:
+
+    def __init__(self, max_files=max_files):
+        self.max_files = max_files
+        self._files = OrderedDict()
+        self._derived = {}  # name -> (stamps, value) for values built from several files
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        with self._lock:
+            cached = self._files.get(path)
+            if cached is not None:
+                self._files.move_to_end(path)
+        if cached is None:
+            cached = CachedFile(path).refresh()  # nothing is kept for a missing file
+            with self._lock:
+                cached = self._files.setdefault(path, cached)
+                while len(self._files) > self.max_files:
+                    self._files.popitem(last=False)
+            return cached
+        try:
+            return cached.refresh()
+        except OSError:
+            with self._lock:
+                if self._files.get(path) is cached:
+                    del self._files[path]
+            raise
+
+    def derived(self, name, paths, build):
+        # build(*cached_files) is only called again when one of the files changed
+        files = [self.get(path) for path in paths]
+        stamps = tuple(cached.stamp for cached in files)
+        entry = self._derived.get(name)
+        if entry is not None and entry[0] == stamps:
+            return entry[1]
+        value = build(*files)
+        self._derived[name] = (stamps, value)
+        return value
+
+
+file_cache = FileCache()
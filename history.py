@@ -0,0 +1,163 @@
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from datetime import datetime
+
+
+# Append-only store for the per-device records built by data.get_port_data.
+# One row per (timestamp, ip), with the counters as columns and the five
+# port/protocol tables as one JSON blob, zlib-compressed by default.
+# The database runs in WAL mode so range queries don't block the collector.
+
+history_db_path = "/home/guru/darkstat_history.db"
+json_files_dir = "/home/guru/json_files"
+
+timestamp_format = "%Y-%m-%d %H:%M:%S"
+
+PORT_TABLES = (
+    'TCP ports on this host',
+    'TCP ports on remote hosts',
+    'UDP ports on this host',
+    'UDP ports on remote hosts',
+    'IP Protocols',
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS device_samples (
+    ts INTEGER NOT NULL,
+    ip TEXT NOT NULL,
+    mac TEXT,
+    name TEXT,
+    bytes_in INTEGER,
+    bytes_out INTEGER,
+    bytes_total INTEGER,
+    last_seen TEXT,
+    compressed INTEGER NOT NULL,
+    ports BLOB,
+    PRIMARY KEY (ts, ip)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS device_samples_ip_ts ON device_samples (ip, ts);
+"""
+
+
+def to_epoch(value):
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.strptime(value, timestamp_format)
+    return int(time.mktime(value.timetuple()))
+
+
+class HistoryStore:
+
+    def __init__(self, path=history_db_path, compress=True):
+        self.path = path
+        self.compress = compress
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _encode_ports(self, record):
+        ports = json.dumps([record.get(table, []) for table in PORT_TABLES], separators=(",", ":")).encode()
+        if self.compress:
+            return 1, zlib.compress(ports)
+        return 0, ports
+
+    def append(self, records):
+        rows = []
+        for record in records:
+            compressed, ports = self._encode_ports(record)
+            rows.append((
+                to_epoch(record['Timestamp']),
+                record['IP Address'],
+                record['MAC Address'],
+                record['Name'],
+                record['In'],
+                record['Out'],
+                record['Total'],
+                record['Last seen'],
+                compressed,
+                ports,
+            ))
+        if not rows:
+            return 0
+
+        with self._lock, self._conn:
+            # Re-imports and retried cycles must not duplicate samples
+            cursor = self._conn.executemany("INSERT OR IGNORE INTO device_samples VALUES (?,?,?,?,?,?,?,?,?,?)", rows)
+        return cursor.rowcount
+
+    def range(self, start=None, end=None, ip=None, with_ports=True):
+        # start/end are epoch seconds, datetimes or "%Y-%m-%d %H:%M:%S" strings,
+        # both inclusive. Records come back oldest first in get_port_data shape.
+        query = "SELECT ts, ip, mac, name, bytes_in, bytes_out, bytes_total, last_seen, compressed, ports FROM device_samples"
+        clauses, params = [], []
+        if ip is not None:
+            clauses.append("ip = ?")
+            params.append(ip)
+        if start is not None:
+            clauses.append("ts >= ?")
+            params.append(to_epoch(start))
+        if end is not None:
+            clauses.append("ts <= ?")
+            params.append(to_epoch(end))
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY ts, ip"
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+
+        records = []
+        for ts, ip_address, mac, name, bytes_in, bytes_out, bytes_total, last_seen, compressed, ports in rows:
+            record = {
+                'Timestamp': datetime.fromtimestamp(ts).strftime(timestamp_format),
+                'IP Address': ip_address,
+                'MAC Address': mac,
+                'In': bytes_in,
+                'Out': bytes_out,
+                'Total': bytes_total,
+                'Name': name,
+                'Last seen': last_seen,
+            }
+            if with_ports:
+                tables = json.loads(zlib.decompress(ports) if compressed else ports)
+                record.update(zip(PORT_TABLES, tables))
+            records.append(record)
+        return records
+
+    def import_json_files(self, directory=json_files_dir):
+        # One-off import of the old one-file-per-cycle dumps from data.py
+        imported = 0
+        for filename in sorted(glob.glob(os.path.join(directory, "*.json"))):
+            try:
+                with open(filename, "r") as json_file:
+                    data = json.load(json_file).get("data")
+            except (OSError, ValueError, AttributeError) as e:
+                print(f"Skipping {filename}: {e}")
+                continue
+            if isinstance(data, list):  # "Interface is down" cycles have no records
+                imported += self.append(data)
+        return imported
+
+
+if __name__ == "__main__":
+    # python -m darkstat.history import [json_files_dir] [history_db_path]
+    if len(sys.argv) >= 2 and sys.argv[1] == "import":
+        directory = sys.argv[2] if len(sys.argv) > 2 else json_files_dir
+        store = HistoryStore(sys.argv[3] if len(sys.argv) > 3 else history_db_path)
+        print(f"Imported {store.import_json_files(directory)} device samples from {directory}")
+        store.close()
+    else:
+        print("usage: python -m darkstat.history import [json_files_dir] [history_db_path]")
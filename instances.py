@@ -0,0 +1,98 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+# The darkstat instances one API process serves, and the resources they
+# share. Instances come from, in order of precedence:
+#
+#   DARKSTAT_INSTANCES="lan1:enp3s0:5554:lan,wan1:enp1s0:5555:wan"
+#   a JSON file (DARKSTAT_INSTANCES_FILE, default instances.json):
+#       [{"name": "lan1", "interface": "enp3s0", "port": 5554, "role": "lan"}, ...]
+#   default_instances below
+#
+# An instance may also name the file darkstat writes with --export (a fifth
+# field, or "export" in JSON); it is read instead of scraping while fresh,
+# and the collector asks darkstat to rewrite it every cycle (see exports.py).
+#
+# Every instance is served under /<name>/..., so adding one is a config
+# change. Parsing and collection for all of them run on one shared thread
+# pool instead of threads per instance; the API fetches no host detail pages
+# (see data.index_port_data).
+
+instances_file = os.environ.get("DARKSTAT_INSTANCES_FILE", "instances.json")
+worker_count = int(os.environ.get("DARKSTAT_WORKERS", min(32, (os.cpu_count() or 1) + 4)))
+
+ROLES = ("lan", "wan")
+
+default_instances = [
+    ("lan1", "enp3s0", "5554", "lan"),
+    ("lan2", "enp4s0", "20000", "lan"),
+    ("wan1", "enp1s0", "5555", "wan"),
+    ("wan2", "enp2s0", "40000", "wan"),
+]
+
+
+class Instance:
+    __slots__ = ("name", "interface", "port", "role", "export")
+
+    def __init__(self, name, interface, port, role, export=None):
+        if role not in ROLES:
+            raise ValueError(f"Instance {name}: role must be one of {', '.join(ROLES)}, not {role!r}")
+        if not str(port).isdigit():
+            raise ValueError(f"Instance {name}: invalid darkstat port {port!r}")
+        self.name = name
+        self.interface = interface
+        self.port = str(port)  # the caches and clients key on the port as a string
+        self.role = role
+        self.export = export or None  # darkstat --export file, optional
+
+    def __repr__(self):
+        return f"Instance({self.name!r}, {self.interface!r}, {self.port!r}, {self.role!r}, {self.export!r})"
+
+
+def parse_instances(spec):
+    # "name:interface:port:role[:export file],..." as used in DARKSTAT_INSTANCES
+    instances = []
+    for entry in spec.split(","):
+        if entry.strip():
+            fields = entry.strip().split(":", 4)
+            if len(fields) not in (4, 5):
+                raise ValueError(f"Invalid instance {entry!r}, expected name:interface:port:role[:export file]")
+            instances.append(Instance(*fields))
+    return instances
+
+
+def read_instances_file(path):
+    with open(path, "r") as f:
+        entries = json.load(f)
+    return [Instance(entry["name"], entry["interface"], entry["port"], entry["role"], entry.get("export"))
+            for entry in entries]
+
+
+def load_instances():
+    # name -> Instance, in configuration order
+    spec = os.environ.get("DARKSTAT_INSTANCES")
+    if spec:
+        instances = parse_instances(spec)
+    elif os.path.exists(instances_file):
+        instances = read_instances_file(instances_file)
+    else:
+        instances = [Instance(*instance) for instance in default_instances]
+
+    registry = {}
+    for instance in instances:
+        if instance.name in registry:
+            raise ValueError(f"Instance {instance.name} is configured twice")
+        registry[instance.name] = instance
+    return registry
+
+
+worker_pool = ThreadPoolExecutor(max_workers=worker_count, thread_name_prefix="darkstat-worker")
+
+
+async def run_in_worker(func, *args):
+    # asyncio.to_thread, but on the shared pool
+    return await asyncio.get_running_loop().run_in_executor(worker_pool, partial(func, *args))
@@ -0,0 +1,145 @@
+import errno
+import fcntl
+import socket
+import struct
+import threading
+import time
+
+
+# Interface state without forking `ip`: operstate comes from sysfs and the
+# IPv4 address/netmask from ioctl. Results are cached until rtnetlink reports
+# a link or address change. Where netlink is not available the cache falls
+# back to a short TTL.
+
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV6_IFADDR = 0x100
+
+fallback_ttl = 5       # seconds, used when netlink events are not available
+max_state_age = 300    # re-read now and then even with netlink, in case events were lost
+
+
+def read_operstate(interface_name):
+    try:
+        with open(f"/sys/class/net/{interface_name}/operstate", "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def read_ipv4_address(interface_name):
+    ifreq = struct.pack("256s", interface_name.encode()[:15])
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            address = fcntl.ioctl(sock.fileno(), SIOCGIFADDR, ifreq)[20:24]
+            netmask = fcntl.ioctl(sock.fileno(), SIOCGIFNETMASK, ifreq)[20:24]
+    except OSError as e:
+        print(f"Error reading address of {interface_name}: {e}")
+        return None
+
+    prefix_len = bin(int.from_bytes(netmask, "big")).count("1")
+    return socket.inet_ntoa(address), prefix_len
+
+
+def read_ipv6_addresses(interface_name):
+    # Global-scope IPv6 addresses as [(address, prefix_len)], from procfs
+    addresses = []
+    try:
+        with open("/proc/net/if_inet6", "r") as f:
+            for line in f:
+                values = line.split()
+                if len(values) >= 6 and values[5] == interface_name and values[3] == "00":
+                    address = socket.inet_ntop(socket.AF_INET6, bytes.fromhex(values[0]))
+                    addresses.append((address, int(values[2], 16)))
+    except OSError:
+        pass
+    return addresses
+
+
+class InterfaceMonitor:
+
+    def __init__(self):
+        self._state = {}  # interface -> (read_at, is_up, (local_ip, prefix_len) or None, [(ipv6, prefix_len)])
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._watcher = None
+        self.watching = False
+
+    def _start_watcher(self):
+        try:
+            sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+            sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV6_IFADDR))
+        except (AttributeError, OSError) as e:
+            print(f"rtnetlink not available, caching interface state for {fallback_ttl}s: {e}")
+            self._watcher = False
+            return
+
+        self._watcher = threading.Thread(target=self._watch, args=(sock,), name="interface-monitor", daemon=True)
+        self.watching = True
+        self._watcher.start()
+
+    def _watch(self, sock):
+        while True:
+            try:
+                sock.recv(65536)
+            except OSError as e:
+                if e.errno == errno.ENOBUFS:
+                    # The kernel dropped events, so we can't know what changed
+                    self.invalidate()
+                    continue
+                print(f"Interface monitor stopped: {e}")
+                self.watching = False
+                self.invalidate()
+                return
+            # Any link or address message may change what we serve
+            self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._state.clear()
+
+    def _get(self, interface_name):
+        if self._watcher is None:
+            with self._lock:
+                if self._watcher is None:
+                    self._start_watcher()
+
+        max_age = max_state_age if self.watching else fallback_ttl
+        state = self._state.get(interface_name)
+        if state is not None and time.monotonic() - state[0] < max_age:
+            return state
+
+        generation = self._generation
+        is_up = read_operstate(interface_name) == "up"
+        state = (
+            time.monotonic(),
+            is_up,
+            read_ipv4_address(interface_name) if is_up else None,
+            read_ipv6_addresses(interface_name) if is_up else [],
+        )
+        with self._lock:
+            # Don't cache a read that raced with a change notification
+            if generation == self._generation:
+                self._state[interface_name] = state
+        return state
+
+    def is_up(self, interface_name):
+        return self._get(interface_name)[1]
+
+    def get_subnet(self, interface_name):
+        state = self._get(interface_name)
+        if state[2] is None and not state[1]:
+            # Down interfaces skip the ioctl, read it on demand
+            return read_ipv4_address(interface_name)
+        return state[2]
+
+    def get_ipv6_subnets(self, interface_name):
+        return self._get(interface_name)[3]
+
+
+interface_monitor = InterfaceMonitor()
@@ -1,192 +1,369 @@
 import time
-import re
-import requests
-import json
-from bs4 import BeautifulSoup
-import ipaddress
-import subprocess
 import xml.etree.ElementTree as ET
 from datetime import datetime, timedelta
 
-
-lease_file_path = "/var/lib/misc/dnsmasq.leases"
+from darkstat.archive import get_archive, record_traffic
+from darkstat.client import fetch_page, get_client
+from darkstat.details import last_seen_seconds
+from darkstat.exports import export_files, get_export, graphs_root, hosts_table_rows
+from darkstat.instances import run_in_worker
+from darkstat.interfaces import interface_monitor
+from darkstat.leases import lease_index
+from darkstat.metrics import timed
+from darkstat.parsers import parse_hosts_table
+from darkstat.portindex import get_port_index
+from darkstat.rankings import HostRankings
+from darkstat.records import Device, convert_bytes_to_human_readable, format_devices
+from darkstat.rates import HostRates
+from darkstat.snapshots import SnapshotCache
+from darkstat.subnets import get_classifier
 
 
 def get_subnet(interface_name):
-    try:
-        result = subprocess.run(["ip", "-j", "-o", "addr", "show", interface_name], capture_output=True, text=True, check=True)
-        data = json.loads(result.stdout)
-        local_ip = data[0]["addr_info"][0]["local"]
-        prefix_len = data[0]["addr_info"][0]["prefixlen"]
-        return local_ip, prefix_len
+    return interface_monitor.get_subnet(interface_name)
 
 
-    except subprocess.CalledProcessError as e:
-        print(f"Error executing 'ip' command: {e}")
-        return None
-    except (json.JSONDecodeError, IndexError, KeyError) as e:
-        print(f"Error parsing JSON output: {e}")
-        return None
+def convert_to_human_readable(devices):
+    for device in devices:
+        device["In"] = convert_bytes_to_human_readable(device["In"])
+        device["Out"] = convert_bytes_to_human_readable(device["Out"])
+        device["Total"] = convert_bytes_to_human_readable(device["Total"])
+    return devices
 
 
-def get_device_name_from_lease(ip_address, mac_address):
+def refresh_page(url):
+    # Timeouts, backoff with jitter and the per-instance circuit breaker live
+    # in client.py; raises DarkstatUnavailable instead of returning None
+    return fetch_page(url)
 
 
-    try:
-        with open(lease_file_path, 'r') as lease_file:
-            leases = lease_file.readlines()
+def is_interface_up(interface_name):
+    return interface_monitor.is_up(interface_name)
 
 
-        mac_address = mac_address.lower()  # Convert MAC address to lowercase because mac address in lease file is in lowercase
+def extract_data(interface,port):
+    if is_interface_up(interface):
+        with timed("extract_data", interface, port):
+            ip_data = hosts_from_export(interface, port)
+            if ip_data is not None:
+                return ip_data
+            html_code = refresh_page(f"http://localhost:{port}/hosts/?full=yes")
+            return parse_hosts_with_timing(interface, port, html_code)
+    else:
+        return False
 
 
-        for line in leases:
-            values = line.strip().split()
-            if len(values) >= 4 and values[2] == ip_address and values[1].lower() == mac_address:   # Check if IP address and MAC address match
-                device_name = values[3]
-                return device_name
-    except FileNotFoundError:
-        print(f"DHCP lease file not found: {lease_file_path}")
-    except Exception as e:
-        print(f"Error reading DHCP lease file: {e}")
+def parse_hosts_with_timing(interface, port, html_code):
+    with timed("parse_hosts", interface, port):
+        return parse_hosts_data(interface, html_code)
 
 
-    return "Unknown"
+def hosts_from_export(interface, port):
+    # Hosts from darkstat's --export file when there is a fresh one, else None
+    with timed("read_export", interface, port):
+        db = get_export(port)
+        if db is None:
+            return None
+        return hosts_from_rows(interface, hosts_table_rows(db))
 
 
-def convert_to_human_readable(devices):
-    def convert_bytes_to_human_readable(bytes_value):
-        if bytes_value < 1024:
-            return f"{bytes_value} B"
-        elif bytes_value < 1024 ** 2:
-            return f"{bytes_value / 1024:.2f} KB"
-        elif bytes_value < 1024 ** 3:
-            return f"{bytes_value / (1024 ** 2):.2f} MB"
-        elif bytes_value < 1024 ** 4:
-            return f"{bytes_value / (1024 ** 3):.2f} GB"
-        else:
-            return f"{bytes_value / (1024 ** 4):.2f} TB"
-    
-    for device in devices:
-        device["In"] = convert_bytes_to_human_readable(device["In"])
-        device["Out"] = convert_bytes_to_human_readable(device["Out"])
-        device["Total"] = convert_bytes_to_human_readable(device["Total"])
-    return devices
+def get_subnet_classifier(interface):
+    # Compiled once per set of interface addresses, IPv4 and global IPv6
+    addresses = []
+    ipv4_subnet = get_subnet(interface)
+    if ipv4_subnet:
+        addresses.append(ipv4_subnet)
+    addresses.extend(interface_monitor.get_ipv6_subnets(interface))
+    return get_classifier(addresses)
 
 
-def is_ip_in_subnet(ip_address, subnet):
-    try:
-        ip_address_obj = ipaddress.ip_address(ip_address)
-        subnet_obj = ipaddress.ip_network(subnet, strict=False)
-        return ip_address_obj in subnet_obj
-    except ValueError:
-        return False
-    
+def host_ip_from_link(ip_link):
+    # darkstat links each host as "./<ip>/", IPv4 or IPv6
+    return ip_link.rstrip("/").rsplit("/", 1)[-1]
 
-def refresh_page(url):
-    retry_attempts = 5
-    retry_delay = 2  # seconds
 
-    for attempt in range(retry_attempts):
-        try:
-            response = requests.get(url)
-            return response.text
-        except requests.exceptions.RequestException as e:
-            time.sleep(retry_delay)
+def parse_hosts_data(interface, html_code):
+    rows = [(host_ip_from_link(ip_link), columns) for ip_link, columns in parse_hosts_table(html_code) if ip_link]
+    return hosts_from_rows(interface, rows)
 
 
-def is_interface_up(interface_name):
-    try:
-        result = subprocess.run(['ip', 'a', 'show', interface_name], capture_output=True, text=True)
-        # Check if the output contains 'state UP' in the status section
-        return 'state UP' in result.stdout
-    except Exception as e:
-        return False
+def hosts_from_rows(interface, rows):
+    # rows: [(ip, hosts-table cells)], from the HTML page or an export file
+    classifier = get_subnet_classifier(interface)
+    in_subnet = classifier.classify([ip_address for ip_address, _ in rows])
 
 
-def extract_data(interface,port):
-    if is_interface_up(interface):
-        local_ip, cidr = get_subnet(interface)
-        subnet = f"{local_ip}/{cidr}"
+    ip_data = []
+
+    lease_index.refresh()  # stat the lease file once per table, not once per row
+
+
+    for (ip_address, columns), is_local in zip(rows, in_subnet):
+        if is_local:
+            data = Device(
+                ip_address,
+                columns[2].upper(),
+                lease_index.lookup(ip_address, columns[2]),
+                int(columns[3].replace(",", "")),
+                int(columns[4].replace(",", "")),
+                int(columns[5].replace(",", "")),
+                columns[6],
+            )
+            ip_data.append(data)
+
+
+    return ip_data
 
 
-        network_address = ipaddress.IPv4Network(subnet, strict=False).network_address
-        broadcast_address = ipaddress.IPv4Network(subnet, strict=False).broadcast_address
+top_n = 10  # devices returned by the top_in/top_out/top_total views
 
+# Incrementally maintained In/Out/Total rankings per (interface, port)
+host_rankings = {}
 
-        excluded_ips = [str(network_address), str(broadcast_address), local_ip]
 
+def get_host_rankings(interface, port):
+    return host_rankings.setdefault((interface, port), HostRankings())
 
-        html_code = refresh_page(f"http://localhost:{port}/hosts/?full=yes")
 
+# Per-host byte rates against the previous snapshot per (interface, port)
+host_rates = {}
 
-        soup = BeautifulSoup(html_code, "html.parser")
-        ip_data = []
 
+def get_host_rates(interface, port):
+    return host_rates.setdefault((interface, port), HostRates())
 
-        for row in soup.find_all("tr", class_=re.compile("alt[12]")):
-            columns = row.find_all("td")
-            ip_link = columns[0].find('a')
 
+def ingest_hosts(interface, port, ip_data, ts=None):
+    # ts: when the hosts table was scraped, now by default
+    if ip_data:
+        with timed("rank_hosts", interface, port):
+            get_host_rankings(interface, port).ingest(ip_data)
+        with timed("host_rates", interface, port):
+            get_host_rates(interface, port).ingest(ip_data, time.time() if ts is None else ts)
+    return ip_data
 
-            if ip_link:
-                ip_match = re.search(r"\d+\.\d+\.\d+\.\d+", ip_link['href'])
-                if ip_match:
-                    ip_address = ip_match.group()
-                    if ip_address in excluded_ips:
-                        continue
 
+def load_hosts(interface, port):
+    return ingest_hosts(interface, port, extract_data(interface, port))
 
-                    if is_ip_in_subnet(ip_address, subnet):
-                        data = {
-                            "IP address": ip_address,
-                            "MAC address":columns[2].text.upper(),
-                            "Name":get_device_name_from_lease(ip_address, mac_address=columns[2].text),
-                            "In":int(columns[3].text.replace(",", "")),
-                            "Out":int(columns[4].text.replace(",", "")),
-                            "Total":int(columns[5].text.replace(",", "")),
-                            "Last seen": columns[6].text
-                        }
-                        ip_data.append(data)
 
+async def refresh_hosts_async(interface, port):
+    # Same as load_hosts but through the async client, result goes straight
+    # into hosts_cache
+    if is_interface_up(interface) and str(port) in export_files:
+        ip_data = await run_in_worker(hosts_from_export, interface, port)
+        if ip_data is not None:
+            hosts_cache.publish((interface, port), ingest_hosts(interface, port, ip_data))
+            return
 
-        return ip_data
+    if is_interface_up(interface):
+        html_code = await get_client(port).fetch("/hosts/?full=yes")
+        # Parsing a large table is CPU work, keep it off the event loop
+        ip_data = await run_in_worker(lambda: ingest_hosts(interface, port, parse_hosts_with_timing(interface, port, html_code)))
     else:
-        return False
+        ip_data = False
+    hosts_cache.publish((interface, port), ip_data)
 
 
-def all_devices(interface,port):
-    ip_data = extract_data(interface,port)
-    if ip_data:
-        return convert_to_human_readable(ip_data)
-    return "Interface is down"
+# extract_data results shared by every view of the same (interface, port)
+hosts_cache = SnapshotCache(load_hosts, name="hosts")
 
 
-def get_top_devices_in_total(interface,port):
-    ip_data = extract_data(interface,port)
-    if ip_data:
-        top_in_total_devices = sorted(ip_data, key=lambda x: x["Total"], reverse=True)[:10]
-        return convert_to_human_readable(top_in_total_devices)
+def get_hosts_snapshot(interface, port):
+    return hosts_cache.get(interface, port)
+
+
+def copy_devices(devices):
+    # convert_to_human_readable rewrites In/Out/Total in place, never hand it
+    # cached graph rows themselves
+    return [dict(device) for device in devices]
+
+
+def get_top_devices(interface, port, field, n=None):
+    if get_hosts_snapshot(interface, port):
+        top_devices = get_host_rankings(interface, port).top(field, n or top_n)
+        return format_devices(top_devices)
     return "Interface is down"
 
 
-def get_top_devices_in_in(interface,port):
-    ip_data = extract_data(interface,port,)
+def all_devices(interface,port):
+    ip_data = get_hosts_snapshot(interface,port)
     if ip_data:
-        top_in_in_devices = sorted(ip_data, key=lambda x: x["In"], reverse=True)[:10]
-        return convert_to_human_readable(top_in_in_devices)
+        return format_devices(ip_data)
     return "Interface is down"
 
 
-def get_top_devices_in_out(interface,port):
-    ip_data = extract_data(interface,port)
-    if ip_data:
-        top_in_out_devices = sorted(ip_data, key=lambda x: x["Out"], reverse=True)[:10]
-        return convert_to_human_readable(top_in_out_devices)
+# ?fields= names accepted by list_devices, besides the record keys themselves
+DEVICE_FIELDS = {
+    "ip": "IP address",
+    "mac": "MAC address",
+    "name": "Name",
+    "in": "In",
+    "out": "Out",
+    "total": "Total",
+    "last_seen": "Last seen",
+}
+
+SORT_FIELDS = {"in": "In", "out": "Out", "total": "Total", "last_seen": "Last seen"}
+
+
+def parse_fields(fields):
+    if not fields:
+        return None
+    keys = []
+    for name in fields.split(","):
+        name = name.strip()
+        if name in DEVICE_FIELDS:
+            keys.append(DEVICE_FIELDS[name])
+        elif name in DEVICE_FIELDS.values():
+            keys.append(name)
+        else:
+            raise ValueError(f"Unknown field: {name}")
+    return keys
+
+
+def list_devices(interface, port, limit=None, offset=0, sort=None, fields=None,
+                 ip_prefix=None, mac_prefix=None, name_prefix=None):
+    # Filters and sorts the snapshot rows by reference and only copies and
+    # formats the requested page. Returns (page, total matching rows).
+    ip_data = get_hosts_snapshot(interface, port)
+    if not ip_data:
+        return "Interface is down", 0
+
+    keys = parse_fields(fields) or list(DEVICE_FIELDS.values())
+
+    if sort is None:
+        candidates = ip_data
+    elif sort in ("in", "out", "total"):
+        # Already ordered by the incremental rankings, highest first
+        candidates = get_host_rankings(interface, port).top(SORT_FIELDS[sort], None)
+    elif sort == "last_seen":
+        def seen_ago(device):
+            seconds = last_seen_seconds(device["Last seen"])
+            return float("inf") if seconds is None else seconds
+        candidates = sorted(ip_data, key=seen_ago)
+    else:
+        raise ValueError(f"Unknown sort field: {sort}")
+
+    if ip_prefix:
+        candidates = [device for device in candidates if device["IP address"].startswith(ip_prefix)]
+    if mac_prefix:
+        mac_prefix = mac_prefix.upper()
+        candidates = [device for device in candidates if device["MAC address"].startswith(mac_prefix)]
+    if name_prefix:
+        name_prefix = name_prefix.lower()
+        candidates = [device for device in candidates if device["Name"].lower().startswith(name_prefix)]
+
+    end = None if limit is None else offset + limit
+    page = format_devices(candidates[offset:end], keys)
+    return page, len(candidates)
+
+
+def get_top_devices_in_total(interface,port,n=None):
+    return get_top_devices(interface, port, "Total", n)
+
+
+def get_top_devices_in_in(interface,port,n=None):
+    return get_top_devices(interface, port, "In", n)
+
+
+def get_top_devices_in_out(interface,port,n=None):
+    return get_top_devices(interface, port, "Out", n)
+
+
+def get_top_devices_by_rate(interface, port, field, n=None):
+    if get_hosts_snapshot(interface, port):
+        top_devices = []
+        for device, rates in get_host_rates(interface, port).top(field, n or top_n):
+            device = device.to_dict()
+            for rate_field, rate in rates.items():
+                device[f"{rate_field} rate"] = f"{convert_bytes_to_human_readable(round(rate))}/s"
+            top_devices.append(device)
+        return top_devices
     return "Interface is down"
 
+
+def get_top_devices_in_rate(interface,port,n=None):
+    return get_top_devices_by_rate(interface, port, "In", n)
+
+
+def get_top_devices_out_rate(interface,port,n=None):
+    return get_top_devices_by_rate(interface, port, "Out", n)
+
+
+def top_ports(interface, port, field="Total", n=None, protocol=None):
+    # Ports and IP protocols carrying the most traffic over all hosts, see portindex.py
+    return convert_to_human_readable(get_port_index(interface, port).top(field, n or top_n, protocol))
+
+
+def port_hosts(interface, port, protocol, number, n=None):
+    devices = get_host_rankings(interface, port).devices
+    hosts = []
+    for row in get_port_index(interface, port).port_hosts(protocol, number, n):
+        device = devices.get(row["IP address"])
+        hosts.append({
+            "IP address": row["IP address"],
+            "MAC address": device.mac if device is not None else "",
+            "Name": device.name if device is not None else "",
+            "In": row["In"],
+            "Out": row["Out"],
+            "Total": row["Total"],
+        })
+    return convert_to_human_readable(hosts)
+
+
+def parse_graphs_xml(xml_data):
+    # extract_* accept either the raw graphs.xml text or an already parsed root
+    if isinstance(xml_data, ET.Element):
+        return xml_data
+    return ET.fromstring(xml_data)
+
+
+def extract_graphs(xml_data, port=""):
+    with timed("parse_graphs", port=port):
+        root = parse_graphs_xml(xml_data)
+    record_traffic(port, root)
+    graphs = {}
+    for name, extract in (("minutes", extract_minutes), ("hours", extract_hours), ("days", extract_days)):
+        with timed(f"extract_{name}", port=port):
+            graphs[name] = extract(root)
+    return graphs
+
+
+def graphs_from_export(port):
+    db = get_export(port)
+    root = graphs_root(db) if db is not None else None
+    return extract_graphs(root, port) if root is not None else None
+
+
+def load_graphs(port):
+    graphs = graphs_from_export(port)
+    if graphs is not None:
+        return graphs
+    xml_data = refresh_page(f"http://localhost:{port}/graphs.xml")
+    return extract_graphs(xml_data, port)
+
+
+# One graphs.xml fetch and parse per WAN port, refreshed at most once per minute
+graphs_cache = SnapshotCache(load_graphs, ttl=60, period=60, name="graphs")
+
+
+def get_graphs_snapshot(port):
+    return graphs_cache.get(port)
+
+
+async def refresh_graphs_async(port):
+    if str(port) in export_files:
+        graphs = await run_in_worker(graphs_from_export, port)
+        if graphs is not None:
+            graphs_cache.publish((port,), graphs)
+            return
+    xml_data = await get_client(port).fetch("/graphs.xml")
+    graphs_cache.publish((port,), await run_in_worker(extract_graphs, xml_data, port))
+
+
 def extract_minutes(xml_data):
-    root = ET.fromstring(xml_data)
+    root = parse_graphs_xml(xml_data)
     minutes_data = []
     current_time = datetime.now()
 
@@ -208,7 +385,7 @@ def extract_minutes(xml_data):
     return minutes_data
 
 def extract_hours(xml_data):
-    root = ET.fromstring(xml_data)
+    root = parse_graphs_xml(xml_data)
     hours_data = []
 
     encountered_zero = False
@@ -241,7 +418,7 @@ def extract_hours(xml_data):
     return hours_data
 
 def extract_days(xml_data):
-    root = ET.fromstring(xml_data)
+    root = parse_graphs_xml(xml_data)
     days_data = []
     current_month = datetime.now().month
     current_year = datetime.now().year
@@ -259,7 +436,11 @@ def extract_days(xml_data):
                 # Days in the previous month
                 previous_month = current_month - 1 if current_month > 1 else 12
                 previous_year = current_year - 1 if current_month == 1 else current_year
-                days_in_previous_month = datetime(previous_year, previous_month, period_value).strftime('%d-%m-%Y')
+                try:
+                    days_in_previous_month = datetime(previous_year, previous_month, period_value).strftime('%d-%m-%Y')
+                except ValueError:
+                    # darkstat keeps 31 day slots, e.g. no 31st in a 30-day month
+                    continue
                 date_time = days_in_previous_month
             else:
                 # Days in the current month
@@ -277,27 +458,45 @@ def extract_days(xml_data):
 
 def minutes(interface,port):
     if is_interface_up(interface):
-        xml_data = refresh_page(f"http://localhost:{port}/graphs.xml")
-        minutes_data = extract_minutes(xml_data)
+        graphs = get_graphs_snapshot(port)
+        minutes_data = graphs["minutes"] if graphs else None
 
         if minutes_data:
-            return convert_to_human_readable(minutes_data)
+            return convert_to_human_readable(copy_devices(minutes_data))
     return "Interface is down"
 
 def hours(interface,port):
     if is_interface_up(interface):
-        xml_data = refresh_page(f"http://localhost:{port}/graphs.xml")
-        hours_data = extract_hours(xml_data)
+        graphs = get_graphs_snapshot(port)
+        hours_data = graphs["hours"] if graphs else None
 
         if hours_data:
-            return convert_to_human_readable(hours_data)
+            return convert_to_human_readable(copy_devices(hours_data))
     return "Interface is down"
 
 def days(interface,port):
     if is_interface_up(interface):
-        xml_data = refresh_page(f"http://localhost:{port}/graphs.xml")
-        days_data = extract_days(xml_data)
+        graphs = get_graphs_snapshot(port)
+        days_data = graphs["days"] if graphs else None
 
         if days_data:
-            return convert_to_human_readable(days_data)
+            return convert_to_human_readable(copy_devices(days_data))
     return "Interface is down"
+
+
+def traffic_range(port, start, end, step):
+    # Traffic from the long-term archive, see archive.py. Returns the rows
+    # and the tier they were read from, None when the port keeps no archive.
+    archive = get_archive(port)
+    if archive is None:
+        return None
+    tier, buckets = archive.query(start, end, step)
+    rows = []
+    for bucket_start, bytes_in, bytes_out in buckets:
+        rows.append({
+            'DateTime': datetime.fromtimestamp(bucket_start).strftime('%d-%m-%Y %H:%M:%S'),
+            'In': bytes_in,
+            'Out': bytes_out,
+            'Total': bytes_in + bytes_out,
+        })
+    return convert_to_human_readable(rows), tier
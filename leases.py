@@ -0,0 +1,65 @@
+import os
+import threading
+
+
+lease_file_path = "/var/lib/misc/dnsmasq.leases"
+
+
+class LeaseIndex:
+    # In-memory view of the dnsmasq lease file keyed by (ip, mac).
+    # The file is only re-read when its inode, mtime or size changes, so a
+    # request costs one stat() instead of one full scan per host row.
+
+    def __init__(self, path=lease_file_path):
+        self.path = path
+        self.names = {}
+        self._stamp = None
+        self._lock = threading.Lock()
+
+    def _file_stamp(self):
+        st = os.stat(self.path)
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def refresh(self):
+        try:
+            stamp = self._file_stamp()
+        except FileNotFoundError:
+            if self._stamp != "missing":
+                print(f"DHCP lease file not found: {self.path}")
+                self.names = {}
+                self._stamp = "missing"
+            return
+        except OSError as e:
+            print(f"Error reading DHCP lease file: {e}")
+            return
+
+        if stamp == self._stamp:
+            return
+
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            names = {}
+            try:
+                with open(self.path, 'r') as lease_file:
+                    for line in lease_file:
+                        values = line.split()
+                        if len(values) >= 4:
+                            # First entry wins, same as the old linear scan
+                            names.setdefault((values[2], values[1].lower()), values[3])
+            except Exception as e:
+                print(f"Error reading DHCP lease file: {e}")
+                return
+            self.names = names
+            self._stamp = stamp
+
+    def lookup(self, ip_address, mac_address):
+        # No freshness check here, call refresh() once per batch of lookups
+        return self.names.get((ip_address, mac_address.lower()), "Unknown")
+
+    def get_name(self, ip_address, mac_address):
+        self.refresh()
+        return self.lookup(ip_address, mac_address)
+
+
+lease_index = LeaseIndex()
@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+
+# Per-stage timing and counters in the Prometheus text format, served by
+# eps.py at /metrics. No client library needed.
+#
+#   with timed("extract_data", interface, port):
+#       ...
+#
+# When disabled (DARKSTAT_METRICS=0), timed() hands back one shared no-op
+# context manager and count() returns at once, so instrumented code only pays
+# for a function call and a flag check. With DARKSTAT_TIMING_LOG=1 every
+# timed stage also prints one JSON line.
+
+enabled = os.environ.get("DARKSTAT_METRICS", "1") != "0"
+timing_log = os.environ.get("DARKSTAT_TIMING_LOG", "0") == "1"
+
+# seconds
+buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+COUNTER_HELP = {
+    "darkstat_errors_total": "Failed darkstat fetches, by reason",
+    "darkstat_cache_requests_total": "Cache lookups, by cache and result",
+}
+
+_lock = threading.Lock()
+_histograms = {}  # (stage, interface, port) -> [bucket counts..., +Inf count, sum]
+_counters = {}    # (name, sorted label items) -> value
+
+
+def observe(stage, seconds, interface="", port=""):
+    if not enabled:
+        return
+    key = (stage, interface, str(port))
+    index = bisect_left(buckets, seconds)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0] * (len(buckets) + 2)
+        histogram[index] += 1
+        histogram[-1] += seconds
+    if timing_log:
+        print(json.dumps({"stage": stage, "interface": interface, "port": str(port),
+                          "ms": round(seconds * 1000, 3), "at": time.time()}))
+
+
+class _Timer:
+    __slots__ = ("stage", "interface", "port", "start_time")
+
+    def __init__(self, stage, interface, port):
+        self.stage = stage
+        self.interface = interface
+        self.port = port
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.stage, time.perf_counter() - self.start_time, self.interface, self.port)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def timed(stage, interface="", port=""):
+    if not enabled:
+        return _null_timer
+    return _Timer(stage, interface, port)
+
+
+def count(name, value=1, **labels):
+    if not enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def cache_result(cache, hit):
+    count("darkstat_cache_requests_total", cache=cache, result="hit" if hit else "miss")
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(items):
+    return ",".join(f'{name}="{_escape(value)}"' for name, value in items)
+
+
+def render():
+    # The whole registry in the Prometheus text exposition format
+    with _lock:
+        histograms = {key: list(values) for key, values in _histograms.items()}
+        counters = dict(_counters)
+
+    lines = ["# HELP darkstat_stage_seconds Time spent per request stage",
+             "# TYPE darkstat_stage_seconds histogram"]
+    for (stage, interface, port), values in sorted(histograms.items()):
+        labels = _labels((("stage", stage), ("interface", interface), ("port", port)))
+        cumulative = 0
+        for bound, bucket_count in zip(buckets, values):
+            cumulative += bucket_count
+            lines.append(f'darkstat_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+        cumulative += values[len(buckets)]
+        lines.append(f'darkstat_stage_seconds_bucket{{{labels},le="+Inf"}} {cumulative}')
+        lines.append(f"darkstat_stage_seconds_sum{{{labels}}} {values[-1]}")
+        lines.append(f"darkstat_stage_seconds_count{{{labels}}} {cumulative}")
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f"# HELP {name} {COUNTER_HELP.get(name, name)}")
+        lines.append(f"# TYPE {name} counter")
+        for (counter_name, items), value in sorted(counters.items()):
+            if counter_name == name:
+                lines.append(f"{name}{{{_labels(items)}}} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
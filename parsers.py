@@ -0,0 +1,236 @@
+import html
+import re
+
+from bs4 import BeautifulSoup
+
+
+# "fast" is a single-pass regex tokenizer over darkstat's generated HTML,
+# "bs4" is the original BeautifulSoup/html.parser path. Both return the
+# same rows, so callers never need to know which one ran.
+parser_backend = "fast"
+
+HOST_TABLES = (
+    "TCP ports on this host",
+    "TCP ports on remote hosts",
+    "UDP ports on this host",
+    "UDP ports on remote hosts",
+    "IP protocols",
+)
+
+_TAG_RE = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)((?:[^>\"']|\"[^\"]*\"|'[^']*')*)>|<!--.*?-->|<![^>]*>", re.S)
+_ATTR_RE = re.compile(r"""([a-zA-Z_:][-\w:.]*)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""")
+_ALT_ROW_RE = re.compile("alt[12]")
+
+
+def _attr(attrs, name):
+    for m in _ATTR_RE.finditer(attrs):
+        if m.group(1).lower() == name:
+            value = m.group(2)
+            if value is None:
+                value = m.group(3) if m.group(3) is not None else m.group(4)
+            return html.unescape(value)
+    return None
+
+
+def _text(parts):
+    return html.unescape("".join(parts))
+
+
+# Hosts table (/hosts/?full=yes)
+# Each row is (href of the link in the first cell or None, [cell texts]).
+
+def _bs4_hosts_table(html_code):
+    soup = BeautifulSoup(html_code, "html.parser")
+    rows = []
+
+    for row in soup.find_all("tr", class_=_ALT_ROW_RE):
+        columns = row.find_all("td")
+        ip_link = columns[0].find('a') if columns else None
+        href = ip_link.get('href') if ip_link else None
+        rows.append((href, [column.text for column in columns]))
+
+    return rows
+
+
+def _fast_hosts_table(html_code):
+    rows = []
+    row = None    # cell texts of the current alt1/alt2 row
+    cell = None   # text pieces of the current <td>
+    href = None
+    pos = 0
+
+    for m in _TAG_RE.finditer(html_code):
+        if cell is not None and m.start() > pos:
+            cell.append(html_code[pos:m.start()])
+        pos = m.end()
+
+        name = m.group(2)
+        if name is None:  # comment or declaration
+            continue
+        name = name.lower()
+        closing = m.group(1)
+
+        if name == "tr":
+            if row is not None:
+                if cell is not None:
+                    row.append(_text(cell))
+                    cell = None
+                rows.append((href, row))
+                row = None
+            if not closing:
+                row_class = _attr(m.group(3), "class")
+                if row_class and _ALT_ROW_RE.search(row_class):
+                    row = []
+                    href = None
+        elif row is None:
+            continue
+        elif name == "td":
+            if cell is not None:
+                row.append(_text(cell))
+                cell = None
+            if not closing:
+                cell = []
+        elif name == "a" and not closing and cell is not None and not row and href is None:
+            href = _attr(m.group(3), "href")
+
+    if row is not None:
+        if cell is not None:
+            row.append(_text(cell))
+        rows.append((href, row))
+
+    return rows
+
+
+# Host detail page (/hosts/<ip>/)
+# Returns {"IP Address", "MAC Address", "tables": {title: [[cell texts], ...]}}
+# with the header row of each table already dropped.
+
+def _bs4_host_page(html_code):
+    soup = BeautifulSoup(html_code, 'html.parser')
+
+    header = soup.find('h2', class_='pageheader')
+    mac_label = soup.find('b', text='MAC Address:')
+    page = {
+        'IP Address': header.text.strip() if header else "",
+        'MAC Address': mac_label.find_next('tt').text.strip() if mac_label else "",
+        'tables': {},
+    }
+
+    for title in HOST_TABLES:
+        heading = soup.find('h3', text=title)
+        if heading is None:
+            continue
+        table = heading.find_next('table')
+        rows = table.find_all('tr')[1:]  # Skip the header row
+        page['tables'][title] = [[cell.text.strip() for cell in row.find_all('td')] for row in rows]
+
+    return page
+
+
+def _fast_host_page(html_code):
+    page = {'IP Address': None, 'MAC Address': None, 'tables': {}}
+
+    capture = None      # tag whose text is being collected: h2, b, tt or h3
+    captured = []
+    mac_next = False    # saw <b>MAC Address:</b>, the next <tt> holds the MAC
+    pending = []        # h3 titles waiting for the next <table>
+    table = None
+    table_titles = []
+    row = None
+    cell = None
+    pos = 0
+
+    for m in _TAG_RE.finditer(html_code):
+        if m.start() > pos:
+            segment = html_code[pos:m.start()]
+            if capture is not None:
+                captured.append(segment)
+            if cell is not None:
+                cell.append(segment)
+        pos = m.end()
+
+        name = m.group(2)
+        if name is None:
+            continue
+        name = name.lower()
+        closing = m.group(1)
+
+        if capture is not None:
+            if name == capture and closing:
+                text = _text(captured)
+                if name == "h2":
+                    page['IP Address'] = text.strip()
+                elif name == "b":
+                    if text == "MAC Address:":
+                        mac_next = True
+                elif name == "tt":
+                    page['MAC Address'] = text.strip()
+                    mac_next = False
+                elif name == "h3":
+                    if text in HOST_TABLES and text not in page['tables'] and text not in pending:
+                        pending.append(text)
+                capture = None
+            continue
+
+        if not closing:
+            if name == "h2" and page['IP Address'] is None:
+                h2_class = _attr(m.group(3), "class")
+                if h2_class and "pageheader" in h2_class.split():
+                    capture, captured = name, []
+                    continue
+            elif name == "b" and page['MAC Address'] is None:
+                capture, captured = name, []
+                continue
+            elif name == "tt" and mac_next:
+                capture, captured = name, []
+                continue
+            elif name == "h3":
+                capture, captured = name, []
+                continue
+
+        if name == "table":
+            if not closing and table is None and pending:
+                table, table_titles, pending = [], pending, []
+            elif closing and table is not None:
+                if row is not None:
+                    if cell is not None:
+                        row.append(_text(cell).strip())
+                        cell = None
+                    table.append(row)
+                    row = None
+                for title in table_titles:
+                    page['tables'][title] = table[1:]  # Skip the header row
+                table = None
+        elif table is None:
+            continue
+        elif name == "tr":
+            if row is not None:
+                if cell is not None:
+                    row.append(_text(cell).strip())
+                    cell = None
+                table.append(row)
+                row = None
+            if not closing:
+                row = []
+        elif name == "td" and row is not None:
+            if cell is not None:
+                row.append(_text(cell).strip())
+                cell = None
+            if not closing:
+                cell = []
+
+    page['IP Address'] = page['IP Address'] or ""
+    page['MAC Address'] = page['MAC Address'] or ""
+    return page
+
+
+_HOSTS_TABLE_BACKENDS = {"bs4": _bs4_hosts_table, "fast": _fast_hosts_table}
+_HOST_PAGE_BACKENDS = {"bs4": _bs4_host_page, "fast": _fast_host_page}
+
+
+def parse_hosts_table(html_code, backend=None):
+    return _HOSTS_TABLE_BACKENDS[backend or parser_backend](html_code)
+
+
+def parse_host_page(html_code, backend=None):
+    return _HOST_PAGE_BACKENDS[backend or parser_backend](html_code)
@@ -0,0 +1,198 @@
+import heapq
+import itertools
+import threading
+
+from darkstat.exports import protocol_name, service_name
+from darkstat.rankings import Ranking
+from darkstat.snapshots import next_version
+
+
+# Which ports and IP protocols carry LAN traffic, across all hosts of a
+# darkstat instance. Kept as an inverted index from (protocol, port) to the
+# hosts using it and updated host by host as detail records (see
+# data.fetch_port_data) arrive: only the entries of a host that changed move,
+# and the top ports are a slice of sorted lists, the hosts of one port a sort
+# of only that port's hosts.
+#
+# Keys are ("tcp", port), ("udp", port) and ("ip", protocol number). Only a
+# host's own ports count, the tables darkstat also writes to its --export
+# file, so "tcp 443" means the LAN's HTTPS servers whether the index was fed
+# from host pages or from an export. Ports on remote hosts are left out.
+
+PROTOCOLS = ("tcp", "udp", "ip")
+
+PORT_TABLES = (
+    ("tcp", 'TCP ports on this host'),
+    ("udp", 'UDP ports on this host'),
+)
+
+
+def record_entries(record):
+    # {(protocol, port): (in, out)} of one detail record
+    entries = {}
+    for protocol, title in PORT_TABLES:
+        for row in record.get(title, ()):
+            key = (protocol, int(row['Port']))
+            bytes_in, bytes_out = entries.get(key, (0, 0))
+            entries[key] = (bytes_in + row['In'], bytes_out + row['Out'])
+    for row in record.get('IP Protocols', ()):
+        key = ("ip", int(row['Protocol Number']))
+        bytes_in, bytes_out = entries.get(key, (0, 0))
+        entries[key] = (bytes_in + row['In'], bytes_out + row['Out'])
+    return entries
+
+
+def export_entries(host):
+    # record_entries() straight from an exports.ExportHost, without building
+    # the detail record
+    ip_protocols, tcp_ports, udp_ports = host.tables()
+    entries = {}
+    for port, syn, bytes_in, bytes_out in tcp_ports:
+        entries["tcp", port] = (bytes_in, bytes_out)
+    for port, bytes_in, bytes_out in udp_ports:
+        entries["udp", port] = (bytes_in, bytes_out)
+    for protocol, bytes_in, bytes_out in ip_protocols:
+        entries["ip", protocol] = (bytes_in, bytes_out)
+    return entries
+
+
+def key_name(key):
+    protocol, number = key
+    return protocol_name(number) if protocol == "ip" else service_name(number, protocol)
+
+
+class PortIndex:
+
+    fields = ("In", "Out", "Total")
+
+    def __init__(self):
+        self.entries = {}    # ip -> {key: (in, out)} as last indexed
+        self.summaries = {}  # ip -> hosts-table (In, Out, Total) its record was read at
+        self.totals = {}     # key -> [in, out] summed over hosts
+        self.hosts = {}      # key -> {ip: (in, out)}
+        # keys of each protocol by summed field; the top over all protocols
+        # merges the three
+        self.rankings = {(protocol, field): Ranking() for protocol in PROTOCOLS for field in self.fields}
+        self.version = None  # changes whenever the index does, None while empty
+        self._lock = threading.Lock()
+
+    def _move(self, key, ip, old, new):
+        # Moves one host's counters for key; the rankings of the keys are
+        # updated afterwards by _rank, once per batch
+        totals = self.totals.get(key)
+        if totals is None:
+            totals = self.totals[key] = [0, 0]
+            self.hosts[key] = {}
+        if old:
+            totals[0] -= old[0]
+            totals[1] -= old[1]
+        if new:
+            totals[0] += new[0]
+            totals[1] += new[1]
+            self.hosts[key][ip] = new
+        else:
+            del self.hosts[key][ip]
+
+    def _rank(self, touched):
+        # Re-ranks the keys whose totals moved, one batch per ranking
+        changes = {ranking: {} for ranking in self.rankings}
+        for key in touched:
+            totals = self.totals[key]
+            in_use = bool(self.hosts[key])
+            for field, value in zip(self.fields, (totals[0], totals[1], totals[0] + totals[1])):
+                changes[key[0], field][key] = value if in_use else None
+            if not in_use:
+                del self.totals[key], self.hosts[key]
+        for ranking, values in changes.items():
+            if values:
+                self.rankings[ranking].update_many(values)
+
+    def update_many(self, changes, version=None):
+        # changes: (ip, entries, hosts-table summary or None) per host, with
+        # entries as returned by record_entries(); {} drops the host.
+        # version: the leader's version when mirroring its index (shared.py)
+        with self._lock:
+            touched = set()
+            for ip, entries, summary in changes:
+                if summary is not None:
+                    self.summaries[ip] = summary
+                old = self.entries.get(ip, {})
+                if old == entries:
+                    continue
+                for key in old.keys() - entries.keys():
+                    self._move(key, ip, old[key], None)
+                    touched.add(key)
+                for key, counters in entries.items():
+                    if old.get(key) != counters:
+                        self._move(key, ip, old.get(key), counters)
+                        touched.add(key)
+                if entries:
+                    self.entries[ip] = entries
+                else:
+                    self.entries.pop(ip, None)
+            if touched:
+                self._rank(touched)
+            if touched or version is not None:
+                self.version = (version or next_version()) if self.entries else None
+            return bool(touched)
+
+    def ingest(self, records):
+        self.update_many([(record['IP Address'], record_entries(record), None) for record in records])
+
+    def retain(self, ips):
+        # Forget hosts that left the hosts table
+        gone = [ip for ip in set(self.entries) | set(self.summaries) if ip not in ips]
+        self.update_many([(ip, {}, None) for ip in gone])
+        with self._lock:
+            for ip in gone:
+                self.summaries.pop(ip, None)
+
+    def snapshot(self):
+        # ip -> entries; the per-host dicts are replaced, never changed in place
+        with self._lock:
+            return dict(self.entries)
+
+    def stale(self, devices):
+        # Devices whose counters moved since their record was indexed
+        return [device for device in devices
+                if self.summaries.get(device["IP address"]) != (device["In"], device["Out"], device["Total"])]
+
+    def top(self, field, n, protocol=None):
+        # Busiest ports by field, as response rows
+        with self._lock:
+            if protocol is None:
+                merged = heapq.merge(*(self.rankings[protocol, field].keys for protocol in PROTOCOLS))
+                keys = [key for _, key in itertools.islice(merged, n)]
+            else:
+                keys = self.rankings[protocol, field].top(n)
+            return [{
+                "Protocol": key[0],
+                "Port": key[1],
+                "Service": key_name(key),
+                "Hosts": len(self.hosts[key]),
+                "In": self.totals[key][0],
+                "Out": self.totals[key][1],
+                "Total": self.totals[key][0] + self.totals[key][1],
+            } for key in keys]
+
+    def port_hosts(self, protocol, number, n=None):
+        # Hosts using one port or protocol, busiest first. Only that port's
+        # hosts are sorted, never all of them.
+        with self._lock:
+            hosts = list(self.hosts.get((protocol, number), {}).items())
+        order = lambda host: (-(host[1][0] + host[1][1]), host[0])
+        hosts = sorted(hosts, key=order) if n is None or n >= len(hosts) else heapq.nsmallest(n, hosts, key=order)
+        return [{
+            "IP address": ip,
+            "In": bytes_in,
+            "Out": bytes_out,
+            "Total": bytes_in + bytes_out,
+        } for ip, (bytes_in, bytes_out) in hosts]
+
+
+# One index per LAN (interface, port)
+port_indexes = {}
+
+
+def get_port_index(interface, port):
+    return port_indexes.setdefault((interface, port), PortIndex())
@@ -0,0 +1,96 @@
+import itertools
+import threading
+from bisect import bisect_left, insort
+
+
+class Ranking:
+    # Hosts (or ports, see portindex.py) ordered by one counter, highest
+    # first. Keys are (-value, ip) so a plain ascending list gives descending
+    # counters, ties in ip order; "ip" is any sortable id.
+
+    def __init__(self):
+        self.keys = []
+        self.values = {}  # ip -> value currently in keys
+
+    def update(self, ip, value):
+        old = self.values.get(ip)
+        if old == value:
+            return False
+        if old is not None:
+            del self.keys[bisect_left(self.keys, (-old, ip))]
+        insort(self.keys, (-value, ip))
+        self.values[ip] = value
+        return True
+
+    def remove(self, ip):
+        old = self.values.pop(ip, None)
+        if old is not None:
+            del self.keys[bisect_left(self.keys, (-old, ip))]
+
+    def update_many(self, values):
+        # values: ip -> value, None to remove. When a large share of the keys
+        # changed, sorting once is cheaper than moving them one by one.
+        if len(values) * 8 < len(self.keys):
+            for ip, value in values.items():
+                if value is None:
+                    self.remove(ip)
+                else:
+                    self.update(ip, value)
+            return
+        for ip, value in values.items():
+            if value is None:
+                self.values.pop(ip, None)
+            else:
+                self.values[ip] = value
+        self.keys = sorted((-value, ip) for ip, value in self.values.items())
+
+    def top(self, n):
+        return [ip for _, ip in self.keys[:n]]
+
+
+class HostRankings:
+    # In/Out/Total rankings for one darkstat instance, kept up to date as
+    # snapshots are ingested. Only hosts whose counters moved are repositioned,
+    # so a top-N query is a slice of an already sorted list.
+    #
+    # Hosts are ranked as (first seen, ip), so equal counters keep the order
+    # the hosts first appeared in, as the stable sort of the hosts table did.
+
+    fields = ("In", "Out", "Total")
+
+    def __init__(self):
+        self.rankings = {field: Ranking() for field in self.fields}
+        self.devices = {}  # ip -> latest device record
+        self.ids = {}      # ip -> (first seen, ip), its key in the rankings
+        self._seen = itertools.count()
+        self._lock = threading.Lock()
+
+    def ingest(self, devices):
+        # One batch per ranking, so a first snapshot is a single sort
+        with self._lock:
+            changes = {field: {} for field in self.fields}
+            seen = set()
+            for device in devices:
+                ip = device["IP address"]
+                seen.add(ip)
+                self.devices[ip] = device
+                key = self.ids.get(ip)
+                if key is None:
+                    key = self.ids[ip] = (next(self._seen), ip)
+                for field, ranking in self.rankings.items():
+                    if ranking.values.get(key) != device[field]:
+                        changes[field][key] = device[field]
+
+            for ip in [ip for ip in self.devices if ip not in seen]:
+                del self.devices[ip]
+                key = self.ids.pop(ip)
+                for field in self.fields:
+                    changes[field][key] = None
+
+            for field, ranking in self.rankings.items():
+                if changes[field]:
+                    ranking.update_many(changes[field])
+
+    def top(self, field, n):
+        with self._lock:
+            return [self.devices[ip] for _, ip in self.rankings[field].top(n)]
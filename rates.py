@@ -0,0 +1,119 @@
+import threading
+
+import numpy as np
+
+
+# darkstat only reports cumulative byte counters, so rates are derived here by
+# diffing consecutive snapshots. Counters are kept in NumPy arrays and the
+# previous snapshot is aligned to the current one by key, so a whole table is
+# handled in a few array operations instead of a Python loop per host.
+
+RATE_FIELDS = ("In", "Out", "Total")
+
+
+class RateTracker:
+
+    def __init__(self):
+        self.index = {}       # key -> row in counters
+        self.counters = None  # int64 array, one row per key
+        self.timestamp = None
+
+    def update(self, keys, counters, timestamp):
+        # keys: list of hashable row keys, counters: rows of cumulative values.
+        # Returns float64 rates per second, same shape as counters.
+        counters = np.asarray(counters, dtype=np.int64).reshape(len(keys), len(RATE_FIELDS))
+
+        if self.timestamp is None or timestamp <= self.timestamp:
+            rates = np.zeros(counters.shape, dtype=np.float64)
+        else:
+            previous_rows = np.fromiter((self.index.get(key, -1) for key in keys), dtype=np.int64, count=len(keys))
+            known = previous_rows >= 0
+            previous = np.zeros_like(counters)
+            previous[known] = self.counters[previous_rows[known]]
+
+            delta = counters - previous
+            # A counter that went backwards was reset (darkstat restarted or the
+            # host was evicted and re-added), so count it from zero. Keys with
+            # no previous sample have no baseline yet and report 0.
+            delta = np.where(delta < 0, counters, delta)
+            delta[~known] = 0
+            rates = delta / (timestamp - self.timestamp)
+
+        self.index = {key: row for row, key in enumerate(keys)}
+        self.counters = counters
+        self.timestamp = timestamp
+        return rates
+
+
+def top_rows(column, n):
+    # Row numbers of the n largest values, largest first
+    if n < len(column):
+        rows = np.argpartition(-column, n)[:n]
+    else:
+        rows = np.arange(len(column))
+    return rows[np.argsort(-column[rows], kind="stable")]
+
+
+class HostRates:
+    # Per-host In/Out/Total rates for one darkstat instance
+
+    def __init__(self):
+        self.tracker = RateTracker()
+        self.devices = []
+        self.rates = np.zeros((0, len(RATE_FIELDS)))
+        self._lock = threading.Lock()
+
+    def ingest(self, devices, timestamp):
+        keys = [device["IP address"] for device in devices]
+        counters = np.array([[device[field] for field in RATE_FIELDS] for device in devices], dtype=np.int64)
+        with self._lock:
+            rates = self.tracker.update(keys, counters, timestamp)
+            self.devices, self.rates = devices, rates
+
+    def top(self, field, n):
+        # [(device, {"In": rate, "Out": rate, "Total": rate}), ...] fastest first
+        with self._lock:
+            devices, rates = self.devices, self.rates
+        rows = top_rows(rates[:, RATE_FIELDS.index(field)], n)
+        return [(devices[row], dict(zip(RATE_FIELDS, rates[row].tolist()))) for row in rows]
+
+
+PORT_TABLES = (
+    'TCP ports on this host',
+    'TCP ports on remote hosts',
+    'UDP ports on this host',
+    'UDP ports on remote hosts',
+    'IP Protocols',
+)
+
+
+class PortRates:
+    # Per-port rates for the detail records built by data.get_port_data. Every
+    # port and protocol row gets "In rate"/"Out rate"/"Total rate" in bytes/s,
+    # and so does the host record itself.
+
+    def __init__(self):
+        self.hosts = RateTracker()
+        self.ports = RateTracker()
+
+    def annotate(self, records, timestamp):
+        host_keys = [record['IP Address'] for record in records]
+        host_counters = [[record[field] for field in RATE_FIELDS] for record in records]
+        host_rates = self.hosts.update(host_keys, host_counters, timestamp)
+        for record, rates in zip(records, host_rates.tolist()):
+            for field, rate in zip(RATE_FIELDS, rates):
+                record[f"{field} rate"] = rate
+
+        rows, keys, counters = [], [], []
+        for record in records:
+            for table in PORT_TABLES:
+                for row in record.get(table, []):
+                    rows.append(row)
+                    keys.append((record['IP Address'], table, row.get('Port', row.get('Protocol Number'))))
+                    counters.append([row[field] for field in RATE_FIELDS])
+
+        port_rates = self.ports.update(keys, counters, timestamp)
+        for row, rates in zip(rows, port_rates.tolist()):
+            for field, rate in zip(RATE_FIELDS, rates):
+                row[f"{field} rate"] = rate
+        return records
@@ -0,0 +1,59 @@
+def convert_bytes_to_human_readable(bytes_value):
+    if bytes_value < 1024:
+        return f"{bytes_value} B"
+    elif bytes_value < 1024 ** 2:
+        return f"{bytes_value / 1024:.2f} KB"
+    elif bytes_value < 1024 ** 3:
+        return f"{bytes_value / (1024 ** 2):.2f} MB"
+    elif bytes_value < 1024 ** 4:
+        return f"{bytes_value / (1024 ** 3):.2f} GB"
+    else:
+        return f"{bytes_value / (1024 ** 4):.2f} TB"
+
+
+class Device:
+    # One row of darkstat's hosts table. Counters stay integers for the life
+    # of the snapshot; human-readable strings are only produced by to_dict()
+    # when a response is built, so snapshots can be shared between views.
+    # Indexing by the old dict keys ("IP address", "In", ...) still works.
+
+    __slots__ = ("ip", "mac", "name", "bytes_in", "bytes_out", "bytes_total", "last_seen")
+
+    KEYS = {
+        "IP address": "ip",
+        "MAC address": "mac",
+        "Name": "name",
+        "In": "bytes_in",
+        "Out": "bytes_out",
+        "Total": "bytes_total",
+        "Last seen": "last_seen",
+    }
+
+    def __init__(self, ip, mac, name, bytes_in, bytes_out, bytes_total, last_seen):
+        self.ip = ip
+        self.mac = mac
+        self.name = name
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.bytes_total = bytes_total
+        self.last_seen = last_seen
+
+    def __getitem__(self, key):
+        return getattr(self, self.KEYS[key])
+
+    def __repr__(self):
+        return f"Device({self.ip!r}, {self.mac!r}, {self.name!r}, {self.bytes_in}, {self.bytes_out}, {self.bytes_total}, {self.last_seen!r})"
+
+    def to_dict(self, keys=None, human_readable=True):
+        # keys: record keys to include, in order; all of them by default
+        device = {key: getattr(self, attribute) for key, attribute in self.KEYS.items()} if keys is None \
+            else {key: getattr(self, self.KEYS[key]) for key in keys}
+        if human_readable:
+            for key in ("In", "Out", "Total"):
+                if key in device:
+                    device[key] = convert_bytes_to_human_readable(device[key])
+        return device
+
+
+def format_devices(devices, keys=None):
+    return [device.to_dict(keys) for device in devices]
@@ -0,0 +1,193 @@
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from fastapi.responses import Response
+
+from darkstat.metrics import cache_result, timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Serialized responses for views derived from a versioned snapshot. The JSON
+# body (and each compressed variant, built on first request) is produced once
+# per snapshot version and reused until the snapshot changes. Clients that
+# send back the ETag get 304 Not Modified without any body work at all.
+
+min_compress_size = 1024  # bytes, smaller bodies are sent as-is
+gzip_level = 6
+brotli_quality = 5
+max_cached_views = 512  # distinct views (path + query) kept serialized
+# One budget for the serialized views of every darkstat instance
+max_cached_bytes = int(os.environ.get("DARKSTAT_CACHE_MB", "64")) * 1024 * 1024
+
+def dumps(data):
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def accepted_codings(header):
+    # Accept-Encoding as coding -> q value; a coding with q=0 is refused
+    codings = {}
+    for item in header.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+
+def choose_coding(header):
+    # The best accepted compression we can produce, brotli on a tie
+    codings = accepted_codings(header)
+    best, best_q = "identity", 0.0
+    for coding in ("br", "gzip"):
+        if coding == "br" and brotli is None:
+            continue
+        q = codings.get(coding, codings.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+class ViewResult:
+    # What build() returns when the response needs extra headers
+    def __init__(self, data, headers):
+        self.data = data
+        self.headers = headers
+
+
+class _Encoded:
+    def __init__(self, view, version, body):
+        self.view = view
+        self.version = version
+        self.bodies = {"identity": body}
+        self.headers = {}
+        self.size = len(body)
+
+
+def etag(version, coding):
+    # Versions are unique across processes and restarts (see
+    # snapshots.next_version), so workers agree on the ETag of a snapshot.
+    # A strong ETag differs per content-coding.
+    return f'"{version}"' if coding == "identity" else f'"{version}-{coding}"'
+
+
+def etag_matches(if_none_match, tag):
+    # If-None-Match uses the weak comparison: W/ prefixes are ignored, so the
+    # tags of a proxy that compressed our body (e.g. nginx gzip) still match
+    if if_none_match.strip() == "*":
+        return True
+    return any(candidate.strip().removeprefix("W/") == tag for candidate in if_none_match.split(","))
+
+
+class ResponseCache:
+
+    def __init__(self, max_views=max_cached_views, max_bytes=max_cached_bytes):
+        self.max_views = max_views
+        self.max_bytes = max_bytes
+        self.size = 0  # bytes of every cached body, compressed variants included
+        self._views = OrderedDict()  # view name -> _Encoded for its latest version, LRU order
+        self._lock = threading.Lock()
+
+    def _evict(self):
+        # Caller holds self._lock; the most recently used view always stays
+        while len(self._views) > 1 and (len(self._views) > self.max_views or self.size > self.max_bytes):
+            self.size -= self._views.popitem(last=False)[1].size
+
+    def _encoded(self, view, version, build):
+        with self._lock:
+            encoded = self._views.get(view)
+            if encoded is not None and encoded.version == version:
+                self._views.move_to_end(view)
+                cache_result("responses", True)
+                return encoded
+
+        cache_result("responses", False)
+        with timed("build_view"):
+            data = build()
+        headers = {}
+        if isinstance(data, ViewResult):
+            data, headers = data.data, data.headers
+        with timed("encode_json"):
+            body = dumps(data)
+        encoded = _Encoded(view, version, body)
+        encoded.headers = headers
+
+        with self._lock:
+            previous = self._views.get(view)
+            if previous is not None:
+                self.size -= previous.size
+            self._views[view] = encoded
+            self._views.move_to_end(view)
+            self.size += encoded.size
+            self._evict()
+        return encoded
+
+    def _body(self, encoded, coding):
+        body = encoded.bodies.get(coding)
+        if body is None:
+            identity = encoded.bodies["identity"]
+            with timed(f"compress_{coding}"):
+                if coding == "br":
+                    body = brotli.compress(identity, quality=brotli_quality)
+                else:
+                    body = gzip.compress(identity, compresslevel=gzip_level, mtime=0)
+            with self._lock:
+                if coding not in encoded.bodies:
+                    encoded.bodies[coding] = body
+                    encoded.size += len(body)
+                    if self._views.get(encoded.view) is encoded:
+                        self.size += len(body)
+                        self._evict()
+        return body
+
+    def respond(self, request, view, version, build):
+        # view names the response (e.g. "/lan1/all_devices"), version is the
+        # version of every snapshot it is built from, build() returns the data.
+        # A version of None means there is no snapshot, nothing is cached then.
+        if version is None:
+            with timed("build_view"):
+                data = build()
+            with timed("encode_json"):
+                if isinstance(data, ViewResult):
+                    return Response(dumps(data.data), media_type="application/json", headers=data.headers)
+                return Response(dumps(data), media_type="application/json")
+
+        encoded = self._encoded(view, version, build)
+        coding = "identity"
+        if len(encoded.bodies["identity"]) >= min_compress_size:
+            coding = choose_coding(request.headers.get("accept-encoding", ""))
+        headers = dict(encoded.headers, **{"ETag": etag(version, coding), "Vary": "Accept-Encoding"})
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match and etag_matches(if_none_match, headers["ETag"]):
+            return Response(status_code=304, headers=headers)
+
+        if coding != "identity":
+            headers["Content-Encoding"] = coding
+
+        return Response(self._body(encoded, coding), media_type="application/json", headers=headers)
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,232 @@
+import fcntl
+import marshal
+import mmap
+import os
+import re
+import struct
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from darkstat import lan
+from darkstat.portindex import get_port_index
+from darkstat.records import Device
+
+
+# Hosts and graphs snapshots shared between API worker processes (uvicorn
+# --workers / gunicorn). Whichever worker holds an flock on leader.lock runs
+# the collector and writes every snapshot it publishes to a file under
+# snapshot_dir (tmpfs by default). The other workers never contact darkstat:
+# on each request they stat() the snapshot file and, when a new version was
+# written, map it read-only and load it into their own lan.py caches, once
+# per version. The port index (portindex.py) is shared the same way, and
+# followers apply only the hosts whose entries changed.
+#
+# Files are written to a temporary name and renamed into place, so a reader
+# always sees one complete version. If the leader dies the kernel drops its
+# lock, a waiting worker takes it over and starts collecting, and the files
+# of the previous leader keep being served in the meantime.
+#
+# Layout (little-endian), layout_version 1:
+#   4s  magic "DKSN"
+#   H   layout version
+#   H   reserved
+#   Q   snapshot version (unique across leaders, nanosecond based)
+#   d   wall-clock time the snapshot was published
+#   Q   payload length
+#   payload: marshal of plain tuples/dicts/lists, see encode_* below
+
+enabled = os.environ.get("DARKSTAT_SHARED_SNAPSHOTS") == "1" or int(os.environ.get("WEB_CONCURRENCY", "1")) > 1
+snapshot_dir = os.environ.get("DARKSTAT_SNAPSHOT_DIR",
+                              "/dev/shm/darkstat" if os.path.isdir("/dev/shm") else os.path.join(tempfile.gettempdir(), "darkstat"))
+election_interval = 5  # seconds between attempts of a follower to take over
+# Followers load snapshots on their own small pool, so requests never queue
+# behind collection jobs on instances.worker_pool
+sync_workers = 2
+sync_pool = ThreadPoolExecutor(max_workers=sync_workers, thread_name_prefix="snapshot-sync")
+
+MAGIC = b"DKSN"
+LAYOUT_VERSION = 1
+HEADER = struct.Struct("<4sHHQdQ")
+
+
+def _safe(text):
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", str(text))
+
+
+def snapshot_path(directory, kind, key):
+    return os.path.join(directory, "-".join([kind] + [_safe(part) for part in key]) + ".snap")
+
+
+def write_snapshot(path, payload, version, published_at):
+    data = marshal.dumps(payload)
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(HEADER.pack(MAGIC, LAYOUT_VERSION, 0, version, published_at, len(data)))
+            f.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+def read_snapshot(path):
+    # (version, published_at, payload), or None for a missing or foreign file
+    try:
+        with open(path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                if len(mapped) < HEADER.size:
+                    return None
+                magic, layout_version, _, version, published_at, length = HEADER.unpack_from(mapped)
+                if magic != MAGIC or layout_version != LAYOUT_VERSION or len(mapped) < HEADER.size + length:
+                    return None
+                with memoryview(mapped) as view:
+                    payload = marshal.loads(view[HEADER.size:HEADER.size + length])
+    except (OSError, ValueError, EOFError, TypeError) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f"Error reading shared snapshot {path}: {e}")
+        return None
+    return version, published_at, payload
+
+
+def encode_hosts(ip_data):
+    if not ip_data:
+        return ip_data
+    return [(d.ip, d.mac, d.name, d.bytes_in, d.bytes_out, d.bytes_total, d.last_seen) for d in ip_data]
+
+
+def decode_hosts(payload):
+    if not payload:
+        return payload
+    return [Device(*row) for row in payload]
+
+
+class SharedSnapshots:
+
+    def __init__(self, directory=snapshot_dir):
+        self.directory = directory
+        self.is_leader = False
+        self._lock_file = None
+        self._seen = {}  # path -> (file stamp, version) last loaded
+        self._published_ports = {}  # (interface, port) -> index version last written
+        self._stop = threading.Event()
+        self._thread = None
+        self._sync_lock = threading.Lock()
+
+    def try_lead(self):
+        if self.is_leader:
+            return True
+        os.makedirs(self.directory, exist_ok=True)
+        lock_file = open(os.path.join(self.directory, "leader.lock"), "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file  # the lock lives as long as this file object
+        self.is_leader = True
+        return True
+
+    def start(self, on_leader):
+        # on_leader() is called once this worker is the leader, right away or
+        # after taking over from a leader that went away
+        lan.hosts_cache.listeners.append(self._publish_hosts)
+        lan.graphs_cache.listeners.append(self._publish_graphs)
+        if self.try_lead():
+            print(f"Worker {os.getpid()} collects for all workers")
+            on_leader()
+            return
+        # Followers only ever read what the leader publishes
+        lan.hosts_cache.passive = True
+        lan.graphs_cache.passive = True
+        self._thread = threading.Thread(target=self._wait_for_leadership, args=(on_leader,),
+                                        name="snapshot-election", daemon=True)
+        self._thread.start()
+
+    def _wait_for_leadership(self, on_leader):
+        while not self._stop.wait(election_interval):
+            if self.try_lead():
+                print(f"Worker {os.getpid()} took over collection")
+                on_leader()
+                return
+
+    def stop(self):
+        self._stop.set()
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self.is_leader = False
+
+    def _write(self, kind, key, payload, version):
+        # version: the one the leader's own cache gave the snapshot (see
+        # snapshots.next_version), so every worker serves it under one ETag
+        if not self.is_leader:
+            return
+        try:
+            write_snapshot(snapshot_path(self.directory, kind, key), payload, version, time.time())
+        except OSError as e:
+            print(f"Error writing shared snapshot: {e}")
+
+    def _publish_hosts(self, key, value, version):
+        self._write("hosts", key, encode_hosts(value), version)
+
+    def _publish_graphs(self, key, value, version):
+        self._write("graphs", key, value, version)
+
+    def publish_ports(self, interface, port, index):
+        # The leader's port index, as ip -> {(protocol, port): (in, out)},
+        # written again only when it changed
+        if self._published_ports.get((interface, port)) == index.version:
+            return
+        self._published_ports[(interface, port)] = index.version
+        self._write("ports", (interface, port), index.snapshot(), index.version)
+
+    def _load(self, kind, key):
+        # Newer snapshot from the leader, or None when there is nothing new
+        path = snapshot_path(self.directory, kind, key)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        seen = self._seen.get(path)
+        if seen is not None and seen[0] == stamp:
+            return None
+        snapshot = read_snapshot(path)
+        if snapshot is None or (seen is not None and snapshot[0] <= seen[1]):
+            return None
+        self._seen[path] = (stamp, snapshot[0])
+        return snapshot
+
+    def sync_hosts(self, interface, port):
+        if self.is_leader:
+            return
+        with self._sync_lock:
+            snapshot = self._load("hosts", (interface, port))
+            if snapshot is not None:
+                version, published_at, payload = snapshot
+                ip_data = lan.ingest_hosts(interface, port, decode_hosts(payload), published_at)
+                lan.hosts_cache.publish((interface, port), ip_data, version)
+
+    def sync_graphs(self, port):
+        if self.is_leader:
+            return
+        with self._sync_lock:
+            snapshot = self._load("graphs", (port,))
+            if snapshot is not None:
+                lan.graphs_cache.publish((port,), snapshot[2], snapshot[0])
+
+    def sync_ports(self, interface, port):
+        if self.is_leader:
+            return
+        with self._sync_lock:
+            snapshot = self._load("ports", (interface, port))
+            if snapshot is not None:
+                version, _, entries = snapshot
+                index = get_port_index(interface, port)
+                gone = [(ip, {}, None) for ip in index.snapshot() if ip not in entries]
+                index.update_many(gone + [(ip, host_entries, None) for ip, host_entries in entries.items()], version)
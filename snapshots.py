@@ -0,0 +1,137 @@
+import threading
+import time
+
+from darkstat.metrics import cache_result
+
+
+cache_ttl = 10  # seconds a hosts table snapshot is served before re-scraping
+
+# Every stored snapshot gets a version from next_version(), so anything
+# derived from a snapshot (serialized responses, ETags) can be keyed on it.
+# Versions come from the nanosecond clock, so they are never reused by a
+# restarted process or by another worker taking over collection (shared.py).
+_last_version = 0
+_version_lock = threading.Lock()
+
+
+def next_version():
+    global _last_version
+    with _version_lock:
+        _last_version = max(_last_version + 1, time.time_ns())
+        return _last_version
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SnapshotCache:
+    # Per-key TTL cache with single-flight loading: when several callers miss
+    # the same key at once, only the first one runs the loader and the rest
+    # block until its result is ready.
+    # With a period set, entries also expire when the wall clock crosses the
+    # next multiple of period seconds (e.g. period=60 for minute boundaries).
+    # In passive mode the loader is never called from get(): values only
+    # arrive through publish() (from the background collector or the async
+    # refreshers in lan.py) and get() returns the latest one whatever its age,
+    # or None before the first publish. It never blocks.
+    # Listeners are called as listener(key, value, version) after every
+    # publish(), e.g. to hand the snapshot to other worker processes.
+
+    def __init__(self, loader, ttl=cache_ttl, period=None, name=None):
+        self.loader = loader
+        self.name = name  # label for the hit/miss counters, not counted when None
+        self.ttl = ttl
+        self.period = period
+        self.passive = False
+        self.listeners = []
+        self._entries = {}   # key -> (expires_at, period_stamp, value, version)
+        self._inflight = {}  # key -> _Flight
+        self._lock = threading.Lock()
+
+    def _period_stamp(self):
+        if self.period:
+            return int(time.time() // self.period)
+        return None
+
+    def _store(self, key, value, version=None):
+        # Caller holds self._lock
+        version = next_version() if version is None else version
+        self._entries[key] = (time.monotonic() + self.ttl, self._period_stamp(), value, version)
+        return version
+
+    def publish(self, key, value, version=None):
+        # version: keep one given by the publisher instead of numbering it here
+        with self._lock:
+            version = self._store(key, value, version)
+        for listener in self.listeners:
+            listener(key, value, version)
+
+    def peek(self, *key):
+        # Latest value whatever its age, None if nothing was loaded yet
+        entry = self._entries.get(key)
+        return entry[2] if entry is not None else None
+
+    def version(self, *key):
+        # Version of the value peek() would return, None if there is none
+        entry = self._entries.get(key)
+        return entry[3] if entry is not None else None
+
+    def in_period(self, *key):
+        # True while the latest value was stored within the current period
+        # (never without a period), i.e. a new load would find nothing newer
+        entry = self._entries.get(key)
+        return entry is not None and self.period is not None and entry[1] == self._period_stamp()
+
+    def get(self, *key):
+        if self.passive:
+            value = self.peek(*key)
+            if self.name:
+                cache_result(self.name, value is not None)
+            return value
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic() and entry[1] == self._period_stamp():
+                if self.name:
+                    cache_result(self.name, True)
+                return entry[2]
+
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+
+        if self.name:
+            # Callers that wait on another caller's load count as hits
+            cache_result(self.name, not leader)
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = self.loader(*key)
+            with self._lock:
+                self._store(key, flight.value)
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            flight.done.set()
+
+        return flight.value
+
+    def invalidate(self, *key):
+        with self._lock:
+            if key:
+                self._entries.pop(key, None)
+            else:
+                self._entries.clear()
@@ -0,0 +1,149 @@
+import asyncio
+import threading
+
+from darkstat import lan
+from darkstat.responses import dumps
+
+
+# Live updates for dashboards. Whenever a hosts or graphs snapshot is
+# published (by the collector, or loaded from the leader in shared mode), one
+# message per darkstat instance is computed and serialized once, then handed
+# to every subscriber: for LAN instances the changes to the top-N by Total,
+# for WAN instances the newest minute sample. Nothing is computed per client
+# and nothing at all when the snapshot did not change what they show.
+#
+# Each subscriber has a small queue. A client that falls stream_queue_size
+# messages behind is dropped instead of buffering without bound, and can
+# reconnect to get a fresh full state.
+
+stream_top_n = 10
+stream_queue_size = 16
+keepalive_interval = 15  # seconds between SSE comments / WebSocket pings when idle
+
+TOP_FIELDS = ("IP address", "MAC address", "Name", "In", "Out", "Total", "Last seen")
+
+_DROPPED = None
+
+
+class Subscriber:
+    __slots__ = ("queue", "dropped")
+
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=stream_queue_size)
+        self.dropped = False
+
+
+class Stream:
+    # One instance's state and subscribers
+
+    def __init__(self, instance):
+        self.instance = instance
+        self.state = None      # full-state message, sent first to new subscribers
+        self.last = None       # rows (LAN) or sample (WAN) the last message was built from
+        self.subscribers = set()
+
+    def diff_top(self, devices, version):
+        rows = [device.to_dict(TOP_FIELDS, human_readable=False) for device in devices]
+        previous = {row["IP address"]: row for row in self.last or []}
+        current = {row["IP address"]: row for row in rows}
+        order = [row["IP address"] for row in rows]
+        if self.last is not None and order == [row["IP address"] for row in self.last] \
+                and all(previous[ip] == current[ip] for ip in order):
+            return None
+
+        message = {
+            "type": "top",
+            "instance": self.instance.name,
+            "version": version,
+            "order": order,
+            "upsert": [row for row in rows if previous.get(row["IP address"]) != row],
+            "remove": [ip for ip in previous if ip not in current],
+        }
+        self.last = rows
+        self.state = dumps({"type": "top", "instance": self.instance.name, "version": version,
+                            "order": order, "upsert": rows, "remove": []})
+        return dumps(message)
+
+    def minute_sample(self, graphs, version):
+        samples = graphs.get("minutes") if graphs else None
+        if not samples or samples[-1] == self.last:
+            return None
+        self.last = samples[-1]
+        self.state = dumps({"type": "minute", "instance": self.instance.name, "version": version, "sample": self.last})
+        return self.state
+
+
+class StreamHub:
+
+    def __init__(self, instances):
+        self.streams = {name: Stream(instance) for name, instance in instances.items()}
+        self.loop = None
+        self._lock = threading.Lock()
+        lan.hosts_cache.listeners.append(self._hosts_published)
+        lan.graphs_cache.listeners.append(self._graphs_published)
+
+    def _streams_for(self, role, match):
+        return [stream for stream in self.streams.values() if stream.instance.role == role and match(stream.instance)]
+
+    def _hosts_published(self, key, value, version):
+        interface, port = key
+        for stream in self._streams_for("lan", lambda i: (i.interface, i.port) == (interface, port)):
+            devices = lan.get_host_rankings(interface, port).top("Total", stream_top_n) if value else []
+            with self._lock:
+                message = stream.diff_top(devices, version)
+            self._broadcast(stream, message)
+
+    def _graphs_published(self, key, value, version):
+        port, = key
+        for stream in self._streams_for("wan", lambda i: i.port == port):
+            with self._lock:
+                message = stream.minute_sample(value, version)
+            self._broadcast(stream, message)
+
+    def _broadcast(self, stream, message):
+        # Called from collector threads, the queues belong to the event loop
+        if message is None or not stream.subscribers or self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self._deliver, stream, message)
+
+    def _deliver(self, stream, message):
+        for subscriber in list(stream.subscribers):
+            try:
+                subscriber.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too slow: drop it and free its queue for the end marker
+                stream.subscribers.discard(subscriber)
+                subscriber.dropped = True
+                while not subscriber.queue.empty():
+                    subscriber.queue.get_nowait()
+                subscriber.queue.put_nowait(_DROPPED)
+
+    def subscribe(self, name):
+        self.loop = asyncio.get_running_loop()
+        stream = self.streams[name]
+        subscriber = Subscriber()
+        with self._lock:
+            if stream.state is not None:
+                subscriber.queue.put_nowait(stream.state)
+        stream.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, name, subscriber):
+        self.streams[name].subscribers.discard(subscriber)
+
+    async def messages(self, name):
+        # Serialized messages for one client; None every keepalive_interval
+        # while idle, ends when the client was dropped
+        subscriber = self.subscribe(name)
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), keepalive_interval)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                if message is _DROPPED:
+                    return
+                yield message
+        finally:
+            self.unsubscribe(name, subscriber)
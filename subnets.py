@@ -0,0 +1,77 @@
+import ipaddress
+import socket
+
+
+# Decides which darkstat hosts belong to a LAN interface. The interface's
+# networks are turned into integer ranges once; a host is then one
+# inet_pton() plus range comparisons, with no ipaddress objects per row.
+# The network, broadcast and local addresses are excluded, as before.
+
+def ip_to_int(ip_address):
+    # (version, integer value), or None for anything that is not an address
+    try:
+        if ":" in ip_address:
+            return 6, int.from_bytes(socket.inet_pton(socket.AF_INET6, ip_address), "big")
+        return 4, int.from_bytes(socket.inet_pton(socket.AF_INET, ip_address), "big")
+    except (OSError, ValueError):
+        return None
+
+
+class SubnetClassifier:
+
+    def __init__(self, addresses):
+        # addresses: [(local_ip, prefix_len), ...], IPv4 and/or IPv6
+        self.ranges = {4: [], 6: []}
+        self.excluded = set()
+        for local_ip, prefix_len in addresses:
+            network = ipaddress.ip_network(f"{local_ip}/{prefix_len}", strict=False)
+            first, last = int(network.network_address), int(network.broadcast_address)
+            self.ranges[network.version].append((first, last))
+            self.excluded.add((network.version, int(ipaddress.ip_address(local_ip))))
+            if network.version == 4:
+                self.excluded.add((4, first))
+                self.excluded.add((4, last))
+
+    def contains(self, ip_address):
+        value = ip_to_int(ip_address)
+        if value is None or value in self.excluded:
+            return False
+        number = value[1]
+        for first, last in self.ranges[value[0]]:
+            if first <= number <= last:
+                return True
+        return False
+
+    def classify(self, ip_addresses):
+        # Batch form of contains(): one bool per address, in order
+        excluded = self.excluded
+        ranges = self.ranges
+        pton = socket.inet_pton
+        from_bytes = int.from_bytes
+        result = []
+        for ip_address in ip_addresses:
+            try:
+                version, family = (6, socket.AF_INET6) if ":" in ip_address else (4, socket.AF_INET)
+                number = from_bytes(pton(family, ip_address), "big")
+            except (OSError, ValueError, TypeError):
+                result.append(False)
+                continue
+            if (version, number) in excluded:
+                result.append(False)
+                continue
+            result.append(any(first <= number <= last for first, last in ranges[version]))
+        return result
+
+
+_classifiers = {}
+
+
+def get_classifier(addresses):
+    # One compiled classifier per distinct set of interface addresses
+    key = tuple(addresses)
+    classifier = _classifiers.get(key)
+    if classifier is None:
+        if len(_classifiers) > 64:
+            _classifiers.clear()
+        classifier = _classifiers[key] = SubnetClassifier(key)
+    return classifier